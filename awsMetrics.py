@@ -0,0 +1,221 @@
+# -----------------------------------------------------------------------------
+# AWS call instrumentation shared by the Lambda functions.
+# Importing this module hooks botocore's event system of every client created
+# afterwards (boto3.client, resources, the sessions of credentialBroker and
+# s3transfer alike) and records per operation and region: calls, latency
+# histogram, retries, throttles, errors and bytes sent / received.
+#
+# Wrap a handler with @awsMetrics.instrumented('functionName') to reset the
+# figures at the start of an invocation and print one CloudWatch Embedded
+# Metric Format (EMF) document at its end. Handlers add their own figures
+# (snapshots made, EIPs found, ...) with awsMetrics.count() and awsMetrics.gauge().
+# -----------------------------------------------------------------------------
+
+import bisect
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+from botocore import handlers
+from botocore.utils import determine_content_length
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CrossAccountJobs')
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]  # upper bounds, the last bucket is open
+EMF_MAX_METRICS = 100  # CloudWatch ignores documents declaring more, the rest stay plain properties
+# Error codes counted as throttles, and retried as such by the handlers
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                     'TooManyRequestsException', 'RequestLimitExceeded', 'LimitExceededException', 'SlowDown')
+
+_lock = threading.Lock()
+_operations = {}
+_metrics = collections.OrderedDict()
+
+
+class OperationStats(object):
+    # Figures of one service operation, e.g. ec2.DescribeInstances
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.regions = collections.Counter()
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def percentile(self, pct):
+        # Upper bound of the latency bucket holding the pct percentile, in ms
+        rank = pct / 100.0 * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS_MS[bucket] if bucket < len(LATENCY_BUCKETS_MS) else LATENCY_BUCKETS_MS[-1] * 2
+        return 0
+
+    def as_dict(self):
+        return {'calls': self.calls, 'errors': self.errors, 'retries': self.retries, 'throttles': self.throttles,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received, 'regions': dict(self.regions),
+                'latency_ms': {('le_{0}'.format(bound) if bucket < len(LATENCY_BUCKETS_MS) else 'gt_{0}'.format(LATENCY_BUCKETS_MS[-1])): count
+                               for bucket, (bound, count) in enumerate(zip(LATENCY_BUCKETS_MS + [None], self.histogram)) if count}}
+
+
+def _stats(event_name):
+    # 'after-call.ec2.DescribeInstances' -> the OperationStats of ec2.DescribeInstances
+    parts = event_name.split('.')
+    key = '{0}.{1}'.format(parts[1], parts[2])
+    with _lock:
+        stats = _operations.get(key)
+        if stats is None:
+            stats = _operations[key] = OperationStats()
+    return stats
+
+
+# ---- botocore hooks ------------------------------------------------------------
+def _before_call(context, **kwargs):
+    context['metrics_started'] = time.monotonic()
+
+
+def _after_call(event_name, context, http_response=None, parsed=None, **kwargs):
+    latency_ms = (time.monotonic() - context.get('metrics_started', time.monotonic())) * 1000
+    stats = _stats(event_name)
+    metadata = (parsed or {}).get('ResponseMetadata', {})
+    with _lock:
+        stats.calls += 1
+        stats.regions[context.get('client_region') or 'global'] += 1
+        stats.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+        stats.retries += metadata.get('RetryAttempts', 0)
+        if http_response is None or getattr(http_response, 'status_code', 200) >= 300:
+            stats.errors += 1
+
+
+def _after_call_error(event_name, context, exception=None, **kwargs):
+    _after_call(event_name, context, http_response=None, parsed=None)
+
+
+def _request_created(event_name, request, **kwargs):
+    # aws-chunked uploads (S3 checksums) only state the payload size in a header
+    size = request.headers.get('X-Amz-Decoded-Content-Length')
+    try:
+        size = int(size) if size else determine_content_length(request.body) or 0
+    except Exception:
+        size = 0
+    if size:
+        stats = _stats(event_name)
+        with _lock:
+            stats.bytes_sent += size
+
+
+def _response_received(event_name, response_dict=None, parsed_response=None, **kwargs):
+    stats = _stats(event_name)
+    size = 0
+    if response_dict:
+        size = int(response_dict.get('headers', {}).get('content-length') or 0)
+    code = ((parsed_response or {}).get('Error') or {}).get('Code')
+    with _lock:
+        stats.bytes_received += size
+        if code in THROTTLING_ERRORS:
+            stats.throttles += 1
+
+
+handlers.BUILTIN_HANDLERS.extend([
+    ('before-call', _before_call),
+    ('after-call', _after_call),
+    ('after-call-error', _after_call_error),
+    ('request-created', _request_created),
+    ('response-received', _response_received),
+])
+
+
+# ---- handler figures and the EMF summary --------------------------------------------
+def percentile(values, pct):
+    # Nearest rank percentile of a list of figures, e.g. latencies measured by a handler
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def count(name, value=1, unit='Count'):
+    # Adds value to the metric, summed over the invocation
+    with _lock:
+        current = _metrics.get(name, (0, unit))[0]
+        _metrics[name] = (current + value, unit)
+
+
+def gauge(name, value, unit='None'):
+    # Sets the metric to value
+    with _lock:
+        _metrics[name] = (value, unit)
+
+
+def reset():
+    with _lock:
+        _operations.clear()
+        _metrics.clear()
+
+
+def summary(function_name, duration_ms, error=None, properties=None):
+    # -------------------------------------------------------------------------
+    # The invocation's EMF document: totals and per operation figures as metrics
+    # with the Function dimension, the histograms and region split as properties
+    # -------------------------------------------------------------------------
+    with _lock:
+        operations = dict(_operations)
+        metrics = list(_metrics.items())
+    document = {'Function': function_name, 'Duration': round(duration_ms, 1), 'Error': error}
+    definitions = [{'Name': 'Duration', 'Unit': 'Milliseconds'}]
+
+    def metric(name, value, unit):
+        document[name] = value
+        definitions.append({'Name': name, 'Unit': unit})
+
+    metric('ApiCalls', sum(s.calls for s in operations.values()), 'Count')
+    metric('ApiErrors', sum(s.errors for s in operations.values()), 'Count')
+    metric('ApiRetries', sum(s.retries for s in operations.values()), 'Count')
+    metric('ApiThrottles', sum(s.throttles for s in operations.values()), 'Count')
+    metric('ApiBytesSent', sum(s.bytes_sent for s in operations.values()), 'Bytes')
+    metric('ApiBytesReceived', sum(s.bytes_received for s in operations.values()), 'Bytes')
+    for key, stats in sorted(operations.items()):
+        if not stats.calls:
+            continue
+        metric(key + '.Calls', stats.calls, 'Count')
+        metric(key + '.LatencyP50', stats.percentile(50), 'Milliseconds')
+        metric(key + '.LatencyP99', stats.percentile(99), 'Milliseconds')
+        if stats.retries or stats.throttles:
+            metric(key + '.Retries', stats.retries, 'Count')
+            metric(key + '.Throttles', stats.throttles, 'Count')
+    for name, (value, unit) in metrics:
+        metric(name, value, unit)
+
+    document['Operations'] = {key: stats.as_dict() for key, stats in sorted(operations.items()) if stats.calls}
+    document.update(properties or {})
+    document['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': [['Function']], 'Metrics': definitions[:EMF_MAX_METRICS]}]
+    }
+    return document
+
+
+def instrumented(function_name):
+    # -------------------------------------------------------------------------
+    # Handler decorator: one EMF summary per invocation, also when it raises
+    # -------------------------------------------------------------------------
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event=None, context=None):
+            reset()
+            started = time.monotonic()
+            error = None
+            try:
+                return handler(event, context)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                print(json.dumps(summary(function_name, (time.monotonic() - started) * 1000, error)))
+        return wrapper
+    return decorator
@@ -0,0 +1,34 @@
+# -----------------------------------------------------------------------------
+# Region discovery shared by the Lambda functions. The list of regions returned
+# by describe_regions is cached at module level, so warm containers reuse it
+# until REGION_CACHE_TTL seconds have passed.
+# Set REGION_ALLOW_LIST (comma separated) to only ever work on those regions.
+# -----------------------------------------------------------------------------
+
+import os
+import threading
+import time
+
+REGION_CACHE_TTL = int(os.environ.get('REGION_CACHE_TTL', 3600))
+REGION_ALLOW_LIST = [region.strip() for region in os.environ.get('REGION_ALLOW_LIST', '').split(',') if region.strip()]
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_regions(ec2client, cache_key='default'):
+    # -------------------------------------------------------------------------
+    # Returns the region names available to ec2client, filtered by the allow list.
+    # cache_key separates accounts, since opt-in regions differ between them.
+    # -------------------------------------------------------------------------
+    with _lock:
+        cached = _cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < REGION_CACHE_TTL:
+            return list(cached[1])
+
+    regions = [region['RegionName'] for region in ec2client.describe_regions().get('Regions', [])]
+    if REGION_ALLOW_LIST:
+        regions = [region for region in regions if region in REGION_ALLOW_LIST]
+    with _lock:
+        _cache[cache_key] = (time.monotonic(), regions)
+    return list(regions)
@@ -0,0 +1,503 @@
+# -----------------------------------------------------------------------------
+# Offline benchmark of the four Lambda handlers against a fake AWS backend.
+# Every botocore client (whatever session it comes from) is answered by the
+# FakeAWS fixtures below instead of the network: a 'before-parameter-build'
+# hook keeps the call's parameters and a 'before-call' hook registered last
+# returns the fake response, so the handlers' own botocore hooks still run.
+#
+# Each handler runs in a fresh process, once for wall time, API calls per
+# operation and max RSS, and once more under tracemalloc for peak Python memory.
+# The results are written to / compared with a JSON baseline:
+#
+#   python benchmarkHandlers.py --save              # record the baseline
+#   python benchmarkHandlers.py                     # compare, exit 1 on regressions
+#   python benchmarkHandlers.py --scale 0.1 --handlers getOrphanEIPs
+#
+# --granularity DAILY runs costExplorerReport with daily Cost Explorer results,
+# the case where its cached records dominate the handler's peak memory.
+# --change-frame COLUMNS times costExplorerReport's changeFrame against the
+# row by row loop it replaced, on a 13 month frame that wide.
+# -----------------------------------------------------------------------------
+
+import argparse
+import collections
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+BENCHMARK_BASELINE = os.environ.get('BENCHMARK_BASELINE', 'benchmark-baseline.json')
+HANDLERS = ['crossAccountMaster', 'getOrphanEIPs', 'ec2AutomatedBackup', 'costExplorerReport']
+# Fixture sizes at --scale 1
+FIXTURES = {
+    'accounts': 500,  # accounts in SSM and in the organization
+    'regions': 20,
+    'eips': 10000,  # elastic IPs of the benchmarked account, every other one unassociated
+    'instances': 2000,  # instances tagged backup=true, two volumes each
+    'snapshots': 5000,  # lambda_snapshot snapshots from the last week
+    'ce_groups': 300,  # groups per month in every Cost Explorer response
+}
+REGION_NAMES = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1', 'sa-east-1', 'eu-west-1', 'eu-west-2',
+                'eu-west-3', 'eu-central-1', 'eu-north-1', 'eu-south-1', 'ap-south-1', 'ap-northeast-1', 'ap-northeast-2',
+                'ap-northeast-3', 'ap-southeast-1', 'ap-southeast-2', 'me-south-1', 'af-south-1']
+RECORD_TYPES = ['Usage', 'Credit', 'Refund', 'Upfront', 'Tax', 'RIFee']
+ROLE_ARN = 'arn:aws:iam::{0:012d}:role/crossAccountRole'
+CE_PAGE_GROUPS = 5000  # Cost Explorer results are paged, about this many groups per page
+COST_TAGS = 'team,project'  # cost allocation tags reported by costExplorerReport, ce_groups values each
+
+
+class FakeError(Exception):
+    def __init__(self, code, message, status=400):
+        Exception.__init__(self, message)
+        self.code = code
+        self.status = status
+
+
+class FakeAWS(object):
+    # -------------------------------------------------------------------------
+    # Synthetic fixtures and the operations the handlers call, answered from
+    # memory. latency (seconds) is slept on every call to mimic round trips.
+    # -------------------------------------------------------------------------
+    def __init__(self, fixtures, latency=0.0, seed=1):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.objects = {}  # (bucket, key) -> body of every object put
+        rand = random.Random(seed)
+        self.regions = REGION_NAMES[:fixtures['regions']]
+        self.accounts = [(ROLE_ARN.format(100000000000 + n), 'ext-{0}'.format(n), 'customer{0:04d}'.format(n))
+                         for n in range(fixtures['accounts'])]
+
+        self.addresses = collections.defaultdict(list)
+        for n in range(fixtures['eips']):
+            address = {'PublicIp': '52.{0}.{1}.{2}'.format(n // 65536 % 256, n // 256 % 256, n % 256),
+                       'AllocationId': 'eipalloc-{0:017x}'.format(n), 'Domain': 'vpc'}
+            if n % 2:
+                address['AssociationId'] = 'eipassoc-{0:017x}'.format(n)
+            self.addresses[self.regions[n % len(self.regions)]].append(address)
+
+        self.instances = collections.defaultdict(list)
+        self.volumes = collections.defaultdict(dict)
+        for n in range(fixtures['instances']):
+            region = self.regions[n % len(self.regions)]
+            instance_id = 'i-{0:017x}'.format(n)
+            mappings = []
+            for device in ('/dev/xvda', '/dev/sdf'):
+                volume_id = 'vol-{0:017x}'.format(len(self.volumes[region]) * len(self.regions) + self.regions.index(region))
+                self.volumes[region][volume_id] = {'VolumeId': volume_id, 'Size': rand.choice([8, 20, 100, 500]), 'State': 'in-use',
+                                                   'Attachments': [{'InstanceId': instance_id, 'Device': device, 'State': 'attached'}]}
+                mappings.append({'DeviceName': device, 'Ebs': {'VolumeId': volume_id, 'Status': 'attached'}})
+            self.instances[region].append({
+                'InstanceId': instance_id, 'State': {'Code': 16, 'Name': 'running'}, 'BlockDeviceMappings': mappings,
+                'Tags': [{'Key': 'backup', 'Value': 'true'}, {'Key': 'Name', 'Value': 'server-{0}'.format(n)},
+                         {'Key': 'owner', 'Value': 'ops'}, {'Key': 'application', 'Value': 'app-{0}'.format(n % 7)}]})
+
+        self.snapshots = collections.defaultdict(list)
+        today = datetime.date.today()
+        for n in range(fixtures['snapshots']):
+            region = self.regions[n % len(self.regions)]
+            volume = rand.choice(list(self.volumes[region].values())) if self.volumes[region] else {'VolumeId': 'vol-gone', 'Size': 8}
+            created_on = today - datetime.timedelta(days=1 + n % 7)
+            self.snapshots[region].append({
+                'SnapshotId': 'snap-{0:017x}'.format(n), 'VolumeId': volume['VolumeId'], 'VolumeSize': volume['Size'], 'State': 'completed',
+                'Tags': [{'Key': 'lambda_snapshot', 'Value': 'true'}, {'Key': 'CreatedOn', 'Value': created_on.strftime('%Y/%m/%d')}]})
+
+    def handle(self, service, region, operation, params):
+        with self.lock:
+            self.calls['{0}.{1}'.format(service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        method = getattr(self, '{0}_{1}'.format(service.replace('-', '_'), operation), None)
+        if method is None:
+            raise FakeError('NotImplemented', 'FakeAWS has no {0}.{1}'.format(service, operation), 501)
+        return method(region, params)
+
+    def page(self, items, params, key, default_size=1000):
+        # NextToken pagination over a list, the token is the next offset
+        start = int(params.get('NextToken') or 0)
+        size = params.get('MaxResults') or default_size
+        response = {key: items[start:start + size]}
+        if start + size < len(items):
+            response['NextToken'] = str(start + size)
+        return response
+
+    # ---- STS, SSM, Lambda, Organizations, S3 --------------------------------
+    def sts_AssumeRole(self, region, params):
+        return {'Credentials': {'AccessKeyId': 'ASIAFAKE', 'SecretAccessKey': 'fake', 'SessionToken': 'fake',
+                                'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}}
+
+    def ssm_GetParameters(self, region, params):
+        values = {'crossAccountRoleARNList': [a[0] for a in self.accounts],
+                  'crossAccountExternalIDList': [a[1] for a in self.accounts],
+                  'crossAccountCustomerNameList': [a[2] for a in self.accounts]}
+        return {'Parameters': [{'Name': name, 'Value': ','.join(values[name])} for name in params['Names'] if name in values],
+                'InvalidParameters': [name for name in params['Names'] if name not in values]}
+
+    def lambda_Invoke(self, region, params):
+        return {'StatusCode': 202}
+
+    def organizations_ListAccounts(self, region, params):
+        accounts = [{'Id': arn.split(':')[4], 'Name': name, 'Email': name + '@example.com', 'Status': 'ACTIVE'}
+                    for arn, external_id, name in self.accounts]
+        return self.page(accounts, params, 'Accounts', 20)
+
+    def s3_GetObject(self, region, params):
+        from botocore.response import StreamingBody
+        body = self.objects.get((params['Bucket'], params['Key']))
+        if body is None:
+            raise FakeError('NoSuchKey', 'The specified key does not exist.', 404)
+        return {'Body': StreamingBody(io.BytesIO(body), len(body)), 'ContentLength': len(body)}
+
+    def s3_PutObject(self, region, params):
+        body = params.get('Body', b'')
+        body = body.read() if hasattr(body, 'read') else body
+        with self.lock:
+            self.calls['s3.PutObject bytes'] += len(body)
+            self.objects[(params['Bucket'], params['Key'])] = body
+        return {'ETag': '"fake"'}
+
+    # ---- EC2 ------------------------------------------------------------------
+    def ec2_DescribeRegions(self, region, params):
+        return {'Regions': [{'RegionName': name, 'Endpoint': 'ec2.{0}.amazonaws.com'.format(name)} for name in self.regions]}
+
+    def ec2_DescribeAddresses(self, region, params):
+        return {'Addresses': self.addresses[region]}
+
+    def ec2_DescribeInstances(self, region, params):
+        instances = self.instances[region]
+        if params.get('InstanceIds'):
+            instances = [i for i in instances if i['InstanceId'] in params['InstanceIds']]
+        response = self.page([{'ReservationId': 'r-' + i['InstanceId'][2:], 'Instances': [i]} for i in instances], params, 'Reservations')
+        return response
+
+    def ec2_DescribeVolumes(self, region, params):
+        volumes = list(self.volumes[region].values())
+        if params.get('VolumeIds'):
+            volumes = [self.volumes[region][volume_id] for volume_id in params['VolumeIds']]
+        for f in params.get('Filters', []):
+            if f['Name'] == 'attachment.instance-id':
+                volumes = [v for v in volumes if v['Attachments'][0]['InstanceId'] in f['Values']]
+            if f['Name'] == 'volume-id':
+                volumes = [self.volumes[region][volume_id] for volume_id in f['Values'] if volume_id in self.volumes[region]]
+        return self.page(volumes, params, 'Volumes', 500)
+
+    def ec2_DescribeSnapshots(self, region, params):
+        return self.page(self.snapshots[region], params, 'Snapshots')
+
+    def ec2_CreateSnapshots(self, region, params):
+        instance_id = params['InstanceSpecification']['InstanceId']
+        instance = next(i for i in self.instances[region] if i['InstanceId'] == instance_id)
+        return {'Snapshots': [self.new_snapshot(region, m['Ebs']['VolumeId']) for m in instance['BlockDeviceMappings']]}
+
+    def ec2_CreateSnapshot(self, region, params):
+        return self.new_snapshot(region, params['VolumeId'])
+
+    def new_snapshot(self, region, volume_id):
+        with self.lock:
+            self.calls['ec2 snapshots created'] += 1
+            number = self.calls['ec2 snapshots created']
+        return {'SnapshotId': 'snap-new{0:014x}'.format(number), 'VolumeId': volume_id,
+                'VolumeSize': self.volumes[region][volume_id]['Size'], 'State': 'pending'}
+
+    def ec2_DeleteSnapshot(self, region, params):
+        return {}
+
+    # ---- Cost Explorer ----------------------------------------------------------
+    def group_keys(self, group_by):
+        values = {'RECORD_TYPE': RECORD_TYPES, 'REGION': self.regions,
+                  'LINKED_ACCOUNT': [arn.split(':')[4] for arn, external_id, name in self.accounts][:self.fixtures['ce_groups']],
+                  'SERVICE': ['Service {0:03d}'.format(n) for n in range(self.fixtures['ce_groups'])]}
+        keys = [[]]
+        for group in group_by:
+            keys = [k + [value] for k in keys for value in values.get(group['Key'], ['value-{0}'.format(n) for n in range(self.fixtures['ce_groups'])])]
+        return keys
+
+    def cost(self, start, keys, record_types, record_type_filter):
+        # Deterministic amount of one group and month, summed over the record types
+        # passing the filter, so filtered and RECORD_TYPE grouped requests agree
+        passing = [rt for rt in record_types if record_type_passes(record_type_filter, rt)]
+        return sum(zlib.crc32('|'.join([start] + keys + [rt]).encode()) % 100000 / 100.0 for rt in passing)
+
+    def ce_GetCostAndUsage(self, region, params):
+        # Pages end after the period that reaches CE_PAGE_GROUPS groups, the token
+        # is the index of the next period
+        results = []
+        group_by = params.get('GroupBy', [])
+        keys = self.group_keys(group_by)
+        by_record_type = [n for n, group in enumerate(group_by) if group['Key'] == 'RECORD_TYPE']
+        periods = time_periods(params['TimePeriod'], params.get('Granularity', 'MONTHLY'))
+        first = int(params.get('NextPageToken') or 0)
+        groups_in_page = 0
+        for index, (start, end) in enumerate(periods[first:], first):
+            if groups_in_page >= CE_PAGE_GROUPS:
+                return {'ResultsByTime': results, 'DimensionValueAttributes': [], 'NextPageToken': str(index)}
+            amounts = []
+            for k in keys:
+                if by_record_type:
+                    rest = [key for n, key in enumerate(k) if n != by_record_type[0]]
+                    amount = self.cost(start, rest, [k[by_record_type[0]]], params.get('Filter'))
+                else:
+                    amount = self.cost(start, k, RECORD_TYPES, params.get('Filter'))
+                amounts.append((k, amount))
+            if group_by:
+                groups = [{'Keys': k, 'Metrics': {'UnblendedCost': {'Amount': '{0:.6f}'.format(amount), 'Unit': 'USD'}}}
+                          for k, amount in amounts if amount]
+                results.append({'TimePeriod': {'Start': start, 'End': end}, 'Total': {}, 'Groups': groups, 'Estimated': False})
+                groups_in_page += len(groups)
+            else:
+                results.append({'TimePeriod': {'Start': start, 'End': end}, 'Groups': [], 'Estimated': False,
+                                'Total': {'UnblendedCost': {'Amount': '{0:.6f}'.format(amounts[0][1]), 'Unit': 'USD'}}})
+        return {'ResultsByTime': results, 'DimensionValueAttributes': []}
+
+    def ce_GetReservationCoverage(self, region, params):
+        coverages = []
+        for start, end in time_periods(params['TimePeriod'], params.get('Granularity', 'MONTHLY')):
+            coverage = {'CoverageHours': {'CoverageHoursPercentage': '42.5'}}
+            groups = [{'Attributes': {'linkedAccount': account}, 'Coverage': coverage}
+                      for account in [arn.split(':')[4] for arn, external_id, name in self.accounts[:10]]] if params.get('GroupBy') else []
+            coverages.append({'TimePeriod': {'Start': start, 'End': end}, 'Groups': groups, 'Total': coverage})
+        return {'CoveragesByTime': coverages}
+
+
+def record_type_passes(record_type_filter, record_type):
+    # The RECORD_TYPE filters costExplorerReport builds, plain or negated
+    if not record_type_filter:
+        return True
+    negate = 'Not' in record_type_filter
+    dimensions = (record_type_filter['Not'] if negate else record_type_filter).get('Dimensions', {})
+    if dimensions.get('Key') != 'RECORD_TYPE':
+        raise FakeError('ValidationException', 'FakeAWS only filters on RECORD_TYPE')
+    return (record_type in dimensions['Values']) != negate
+
+
+def time_periods(time_period, granularity):
+    start = datetime.date.fromisoformat(time_period['Start'])
+    end = datetime.date.fromisoformat(time_period['End'])
+    if granularity != 'DAILY':
+        start = start.replace(day=1)
+    periods = []
+    while start < end:
+        if granularity == 'DAILY':
+            following = start + datetime.timedelta(days=1)
+        else:
+            following = (start + datetime.timedelta(days=32)).replace(day=1)
+        periods.append((start.isoformat(), min(following, end).isoformat()))
+        start = following
+    return periods
+
+
+def install(fake):
+    # -------------------------------------------------------------------------
+    # Route every client created from now on to fake. BUILTIN_HANDLERS are added
+    # to each new botocore session, so this covers boto3.client(), resources and
+    # the sessions credentialBroker builds.
+    # -------------------------------------------------------------------------
+    from botocore import handlers
+    from botocore.awsrequest import AWSResponse
+
+    def keep_params(params, context, **kwargs):
+        context['benchmark_params'] = dict(params)
+
+    def respond(model, context, **kwargs):
+        service = model.service_model.service_name
+        try:
+            parsed = fake.handle(service, context.get('client_region'), model.name, context.get('benchmark_params', {}))
+            status = 200
+        except FakeError as e:
+            parsed = {'Error': {'Code': e.code, 'Message': str(e)}}
+            status = e.status
+        parsed.setdefault('ResponseMetadata', {'HTTPStatusCode': status, 'HTTPHeaders': {}, 'RetryAttempts': 0})
+        return AWSResponse('https://fake.amazonaws.com', status, {}, None), parsed
+
+    handlers.BUILTIN_HANDLERS.append(('before-parameter-build', keep_params))
+    handlers.BUILTIN_HANDLERS.append(('before-call', respond, handlers.REGISTER_LAST))
+
+
+def fake_environment(bucket):
+    # Fake credentials, the report bucket and none of the settings that would reach
+    # real AWS or change what the handlers do, for the handlers run in this process
+    os.environ.update(AWS_ACCESS_KEY_ID='fake', AWS_SECRET_ACCESS_KEY='fake', AWS_DEFAULT_REGION='us-east-1',
+                      AWS_REGION='us-east-1', S3_BUCKET=bucket)
+    for variable in ('AWS_PROFILE', 'AWS_SESSION_TOKEN', 'AWS_ENDPOINT_URL', 'REGION_ALLOW_LIST', 'SES_SEND',
+                     'HISTORY_LOCATION', 'EXPORT_FORMAT', 'GRANULARITY', 'FRAME_DTYPE'):
+        os.environ.pop(variable, None)
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+
+
+def load_module(filename):
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(os.path.splitext(filename)[0].replace('-', '_'), os.path.join(BASE_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_handler(name, fixtures, latency, trace, granularity='MONTHLY'):
+    # -------------------------------------------------------------------------
+    # Runs in a fresh process: installs the fake backend, imports the handler's
+    # module and runs it once. Handler output is discarded.
+    # -------------------------------------------------------------------------
+    fake_environment('benchmark-reports')
+    os.environ.update(GRANULARITY=granularity, COST_TAGS=COST_TAGS)
+    fake = FakeAWS(fixtures, latency)
+    install(fake)
+    arn, external_id, customer_name = fake.accounts[0]
+    event = {'ARN': arn, 'externalId': external_id, 'customerName': customer_name}
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if name == 'crossAccountMaster':
+            handler, handler_event = load_module('crossAccountMaster.py').lambda_handler, {}
+        elif name == 'getOrphanEIPs':
+            handler, handler_event = load_module('getOrphanEIPs.py').lambda_handler, event
+        elif name == 'ec2AutomatedBackup':
+            handler, handler_event = load_module('ec2AutomatedBackupLambda.py').lambda_handler, {}
+        else:
+            handler, handler_event = load_module('costExplorerReport-lambda.py').main_handler, event
+        fake.calls.clear()
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        handler(handler_event, None)
+        wall_seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace else None
+        tracemalloc.stop()
+
+    api_calls = {op: n for op, n in sorted(fake.calls.items()) if ' ' not in op}
+    return {'wall_seconds': round(wall_seconds, 3), 'api_calls': api_calls, 'api_total': sum(api_calls.values()),
+            'put_bytes': fake.calls['s3.PutObject bytes'], 'snapshots_created': fake.calls['ec2 snapshots created'],
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+            'peak_python_mb': round(peak / 1024.0 / 1024.0, 1) if trace else None}
+
+
+def in_fresh_process(*args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_handler, *args).result()
+
+
+def compare(results, baseline, tolerance):
+    # Regressions: more API calls, or wall time / peak memory more than tolerance above the baseline
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get('handlers', {}).get(name)
+        if not before:
+            continue
+        if result['api_total'] > before['api_total']:
+            regressions.append('{0}: {1} API calls, baseline {2}'.format(name, result['api_total'], before['api_total']))
+        for metric in ('wall_seconds', 'peak_python_mb'):
+            if before.get(metric) and result.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append('{0}: {1} {2}, baseline {3}'.format(name, metric, result[metric], before[metric]))
+    return regressions
+
+
+def change_frame_loop(df):
+    # The Change style as addReport computed it before changeFrame, kept as reference
+    df = df.copy()
+    dfc = df.copy()
+    lastindex = None
+    for index, row in df.iterrows():
+        if lastindex:
+            for i in row.index:
+                df.at[index, i] = dfc.at[index, i] - dfc.at[lastindex, i]
+        lastindex = index
+    return df
+
+
+def benchmark_change_frame(columns, months=13, repeat=3):
+    # -------------------------------------------------------------------------
+    # Best of repeat timings of the old loop and changeFrame on a months x columns
+    # frame, fails when their results differ
+    # -------------------------------------------------------------------------
+    import pandas as pd
+    module = load_module('costExplorerReport-lambda.py')
+    rand = random.Random(1)
+    dates = ['{0:04d}-{1:02d}-01'.format(2025 + n // 12, n % 12 + 1) for n in range(months)]
+    df = pd.DataFrame([[round(rand.uniform(0, 1000), 2) for column in range(columns)] for date in dates],
+                      index=pd.Index(dates, name='date'), columns=['value-{0}'.format(n) for n in range(columns)])
+    timings = {}
+    for name, function in (('loop', change_frame_loop), ('changeFrame', module.changeFrame)):
+        best = None
+        for attempt in range(repeat):
+            started = time.perf_counter()
+            result = function(df)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = (best, result)
+    difference = (timings['loop'][1] - timings['changeFrame'][1]).abs().values.max()
+    if difference > 1e-9:
+        raise AssertionError('changeFrame differs from the loop by up to {0}'.format(difference))
+    return timings['loop'][0], timings['changeFrame'][0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Lambda handlers against a fake AWS backend.')
+    parser.add_argument('--handlers', default=','.join(HANDLERS), help='comma separated, default: %(default)s')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the fixture sizes, default: %(default)s')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds slept per fake API call, default: %(default)s')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE, help='JSON baseline file, default: %(default)s')
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--granularity', choices=['MONTHLY', 'DAILY'], default='MONTHLY',
+                        help='Cost Explorer granularity of costExplorerReport, default: %(default)s')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed wall time / memory growth, default: %(default)s')
+    parser.add_argument('--change-frame', type=int, metavar='COLUMNS', help='only time changeFrame against the old loop')
+    args = parser.parse_args(argv)
+
+    if args.change_frame:
+        loop_seconds, frame_seconds = benchmark_change_frame(args.change_frame)
+        print('Change style on 13 x {0}: loop {1:.1f} ms, changeFrame {2:.2f} ms, {3:.0f}x faster, same values'.format(
+            args.change_frame, loop_seconds * 1000, frame_seconds * 1000, loop_seconds / frame_seconds))
+        return 0
+
+    fixtures = {key: max(1, int(round(value * args.scale))) if key != 'regions' else value for key, value in FIXTURES.items()}
+    names = [name.strip() for name in args.handlers.split(',') if name.strip()]
+    unknown = [name for name in names if name not in HANDLERS]
+    if unknown:
+        parser.error('unknown handler(s): {0}'.format(', '.join(unknown)))
+
+    results = {}
+    for name in names:
+        result = in_fresh_process(name, fixtures, args.latency, False, args.granularity)
+        if not args.no_memory:
+            result['peak_python_mb'] = in_fresh_process(name, fixtures, args.latency, True, args.granularity)['peak_python_mb']
+        results[name] = result
+        print('{0:<20} {1:>8.2f} s  {2:>6} API calls  peak {3} MB  max RSS {4} MB'.format(
+            name, result['wall_seconds'], result['api_total'], result['peak_python_mb'], result['max_rss_mb']))
+        print('    ' + ', '.join('{0} {1}'.format(op, n) for op, n in result['api_calls'].items()))
+
+    report = {'fixtures': fixtures, 'latency': args.latency, 'granularity': args.granularity, 'python': sys.version.split()[0], 'handlers': results}
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Saved baseline to {0}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at {0}, run with --save to record one'.format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if (baseline.get('fixtures') != fixtures or baseline.get('latency') != args.latency
+            or baseline.get('granularity') != args.granularity):
+        print('Baseline {0} was recorded with other fixtures, not comparing'.format(args.baseline))
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    print('{0} regressions against {1}'.format(len(regressions), args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+# -----------------------------------------------------------------------------
+# Behaviour checks of the Lambda handlers against the FakeAWS backend of
+# benchmarkHandlers.py. Each check runs in a fresh process, asserts what the
+# handler sent to AWS and prints ok or FAIL. Exits 1 when a check fails.
+#
+#   python checkHandlers.py
+#   python checkHandlers.py --checks eipUploads
+#
+# costFusion replays the Cost Explorer responses recorded in
+# COST_EXPLORER_RESPONSES. Record them again (from FakeAWS, or with --live from
+# the account of the current credentials) after changing the report suite:
+#
+#   python checkHandlers.py --record [--live]
+#
+# costFilters checks the fused filter sheets against hand computed totals, so a
+# fixture recorded from FakeAWS does not only check the fake against itself.
+# -----------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import benchmarkHandlers
+
+# Small fixtures, the checks are about what is sent, not how fast
+FIXTURES = dict(benchmarkHandlers.FIXTURES, accounts=3, regions=4, eips=40, instances=8, snapshots=20, ce_groups=5)
+COST_EXPLORER_RESPONSES = os.path.join(benchmarkHandlers.BASE_DIR, 'checkCostExplorerResponses.json')
+COST_TAGS = 'team,user:project'  # Tag reports included in the recorded suite
+COST_TOLERANCE = 1e-6
+
+
+def fake_backend(fixtures=FIXTURES):
+    fake = benchmarkHandlers.FakeAWS(fixtures)
+    benchmarkHandlers.install(fake)
+    benchmarkHandlers.fake_environment('check-reports')
+    return fake
+
+
+def run_quietly(handler, event):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return handler(event, None)
+
+
+def check_eip_uploads():
+    # -------------------------------------------------------------------------
+    # getOrphanEIPs: one DescribeAddresses per region and, per account, two
+    # PutObject calls (page and data file) when the orphan set changed or the
+    # previous state cannot be read, none when it is unchanged since the last run
+    # -------------------------------------------------------------------------
+    fake = fake_backend()
+    handler = benchmarkHandlers.load_module('getOrphanEIPs.py').lambda_handler
+    arn, external_id, customer_name = fake.accounts[0]
+    event = {'ARN': arn, 'externalId': external_id, 'customerName': customer_name}
+
+    run_quietly(handler, event)
+    assert fake.calls['ec2.DescribeAddresses'] == len(fake.regions), \
+        'first run: {0} DescribeAddresses for {1} regions'.format(fake.calls['ec2.DescribeAddresses'], len(fake.regions))
+    assert fake.calls['s3.PutObject'] == 2, 'first run: {0} PutObject, expected 2'.format(fake.calls['s3.PutObject'])
+
+    fake.calls.clear()
+    run_quietly(handler, event)
+    assert fake.calls['s3.PutObject'] == 0, 'unchanged orphan set: {0} PutObject, expected 0'.format(fake.calls['s3.PutObject'])
+
+    fake.calls.clear()
+    released = next(address for address in fake.addresses[fake.regions[0]] if 'AssociationId' not in address)
+    fake.addresses[fake.regions[0]].remove(released)
+    run_quietly(handler, event)
+    assert fake.calls['s3.PutObject'] == 2, 'changed orphan set: {0} PutObject, expected 2'.format(fake.calls['s3.PutObject'])
+
+    def access_denied(region, params):
+        raise benchmarkHandlers.FakeError('AccessDenied', 'Access Denied', 403)
+
+    fake.calls.clear()
+    fake.s3_GetObject = access_denied
+    run_quietly(handler, event)
+    assert fake.calls['s3.PutObject'] == 2, 'unreadable state: {0} PutObject, expected 2'.format(fake.calls['s3.PutObject'])
+
+
+class RecordedAWS(benchmarkHandlers.FakeAWS):
+    # FakeAWS answering Cost Explorer from the recorded responses only
+    def __init__(self, recorded):
+        benchmarkHandlers.FakeAWS.__init__(self, FIXTURES)
+        self.responses = dict((request_key(item['operation'], item['request']), item['response']) for item in recorded['responses'])
+
+    def recorded(self, operation, params):
+        response = self.responses.get(request_key(operation, params))
+        if response is None:
+            raise benchmarkHandlers.FakeError('NotRecorded', 'no recorded {0} response for {1}'.format(operation, json.dumps(params, sort_keys=True)))
+        return json.loads(json.dumps(response))
+
+    def ce_GetCostAndUsage(self, region, params):
+        return self.recorded('GetCostAndUsage', params)
+
+    def ce_GetReservationCoverage(self, region, params):
+        return self.recorded('GetReservationCoverage', params)
+
+
+def request_key(operation, params):
+    return operation + ' ' + json.dumps(params, sort_keys=True)
+
+
+def cost_explorer(module, window=None):
+    # CostExplorer over the recorded window, reports queued but not fetched
+    os.environ['COST_TAGS'] = COST_TAGS
+    costexplorer = module.CostExplorer()
+    if window:
+        for name in ('start', 'end', 'ristart', 'riend'):
+            setattr(costexplorer, name, datetime.date.fromisoformat(window[name]))
+    module.queueReports(costexplorer)
+    return costexplorer
+
+
+def sequential_reports(costexplorer):
+    # Every queued report on its own, like addReport / addRiReport, without fusion
+    queue, costexplorer.queue = costexplorer.queue, []
+    for method, kwargs in queue:
+        costexplorer.reports.append(method(**kwargs))
+    return costexplorer.reports
+
+
+def record_cost_explorer(live=False):
+    # -------------------------------------------------------------------------
+    # Runs the report suite sequentially and fused, writes every Cost Explorer
+    # request and response to COST_EXPLORER_RESPONSES
+    # -------------------------------------------------------------------------
+    from botocore import handlers
+    if not live:
+        fake_backend()
+    responses = {}
+
+    def keep_params(params, context, **kwargs):
+        context['check_params'] = json.loads(json.dumps(params, default=str))
+
+    def keep_response(model, context, parsed, **kwargs):
+        response = dict((key, value) for key, value in parsed.items() if key != 'ResponseMetadata')
+        responses[request_key(model.name, context['check_params'])] = {
+            'operation': model.name, 'request': context['check_params'], 'response': json.loads(json.dumps(response, default=str))}
+
+    handlers.BUILTIN_HANDLERS.append(('before-parameter-build.cost-explorer', keep_params))
+    handlers.BUILTIN_HANDLERS.append(('after-call.cost-explorer', keep_response))
+    module = benchmarkHandlers.load_module('costExplorerReport-lambda.py')
+    sequential = cost_explorer(module)
+    run_quietly(lambda event, context: sequential_reports(sequential), None)
+    fused = cost_explorer(module)
+    run_quietly(lambda event, context: fused.runQueue(), None)
+
+    recorded = {'source': 'live' if live else 'FakeAWS', 'recorded': datetime.date.today().isoformat(),
+                'window': dict((name, getattr(sequential, name).isoformat()) for name in ('start', 'end', 'ristart', 'riend')),
+                'responses': [responses[key] for key in sorted(responses)]}
+    with open(COST_EXPLORER_RESPONSES, 'w') as f:
+        json.dump(recorded, f, indent=1, sort_keys=True)
+    print('Recorded {0} responses to {1}'.format(len(responses), COST_EXPLORER_RESPONSES))
+
+
+def check_cost_fusion():
+    # -------------------------------------------------------------------------
+    # costExplorerReport: the fused runQueue sheets (RECORD_TYPE filter variants
+    # answered from one grouped request) match the sequential addReport sheets
+    # within COST_TOLERANCE, from the recorded responses, in fewer requests, and
+    # no cached records are left once every queued report is built
+    # -------------------------------------------------------------------------
+    with open(COST_EXPLORER_RESPONSES) as f:
+        recorded = json.load(f)
+    fake = RecordedAWS(recorded)
+    benchmarkHandlers.install(fake)
+    benchmarkHandlers.fake_environment('check-reports')
+    module = benchmarkHandlers.load_module('costExplorerReport-lambda.py')
+
+    sequential = cost_explorer(module, recorded['window'])
+    run_quietly(lambda event, context: sequential_reports(sequential), None)
+    sequential_calls = fake.calls['ce.GetCostAndUsage']
+    fake.calls.clear()
+    fused = cost_explorer(module, recorded['window'])
+    run_quietly(lambda event, context: fused.runQueue(), None)
+    fused_calls = fake.calls['ce.GetCostAndUsage']
+
+    assert fused.fused, 'no report was planned for fusion'
+    assert not fused.cache and not fused.cacheUses, 'cache entries kept after their last report: {0}'.format(sorted(fused.cacheUses))
+    assert fused_calls < sequential_calls, '{0} fused requests, {1} sequential'.format(fused_calls, sequential_calls)
+    assert [r['Name'] for r in fused.reports] == [r['Name'] for r in sequential.reports], 'sheets differ'
+    for expected, actual in zip(sequential.reports, fused.reports):
+        name = expected['Name']
+        assert list(actual['Data'].index) == list(expected['Data'].index), '{0}: rows differ'.format(name)
+        assert list(actual['Data'].columns) == list(expected['Data'].columns), '{0}: columns differ'.format(name)
+        difference = (actual['Data'] - expected['Data']).abs().values.max() if expected['Data'].size else 0.0
+        assert difference <= COST_TOLERANCE, '{0}: values differ by up to {1}'.format(name, difference)
+
+
+# Hand written RECORD_TYPE split of two months and the sheets it must give, worked
+# out by hand from the filters of recordTypeFilter, independent of FakeAWS
+RECORD_TYPE_AMOUNTS = {
+    '2026-01-01': {'Usage': 100.0, 'Credit': -10.0, 'Refund': -5.0, 'Upfront': 50.0, 'Tax': 7.5},
+    '2026-02-01': {'Usage': 120.0, 'Credit': -20.0, 'Tax': 8.25, 'RIFee': 3.0},
+}
+EXPECTED_TOTALS = {
+    'Total': [107.5, 131.25],  # NoCredits: without Credit, Refund and Upfront
+    'TotalChange': [107.5, 23.75],
+    'TotalInclCredits': [142.5, 111.25],  # no filter
+    'Credits': [-15.0, -20.0],  # CreditsOnly: Credit and Refund
+    'RIUpfront': [50.0, 0.0],  # UpfrontOnly
+}
+
+
+class RecordTypeClient(object):
+    # Cost Explorer and Organizations stand-in answering from RECORD_TYPE_AMOUNTS
+    def __init__(self):
+        self.requests = []
+
+    def get_cost_and_usage(self, **request):
+        self.requests.append(request)
+        assert request['GroupBy'] == [{'Type': 'DIMENSION', 'Key': 'RECORD_TYPE'}] and 'Filter' not in request, \
+            'unfused request {0}'.format(json.dumps(request, sort_keys=True))
+        return {'ResultsByTime': [
+            {'TimePeriod': {'Start': month, 'End': month}, 'Total': {}, 'Estimated': False,
+             'Groups': [{'Keys': [record_type], 'Metrics': {'UnblendedCost': {'Amount': str(amount), 'Unit': 'USD'}}}
+                        for record_type, amount in amounts.items()]}
+            for month, amounts in sorted(RECORD_TYPE_AMOUNTS.items())]}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self):
+        return [{'Accounts': []}]
+
+
+def check_cost_filters():
+    # -------------------------------------------------------------------------
+    # costExplorerReport: the Total, Credits and Upfront sheets answered from one
+    # RECORD_TYPE grouped request hold the hand computed EXPECTED_TOTALS
+    # -------------------------------------------------------------------------
+    benchmarkHandlers.fake_environment('check-reports')
+    module = benchmarkHandlers.load_module('costExplorerReport-lambda.py')
+    client = RecordTypeClient()
+    costexplorer = module.CostExplorer(Client=client, OrgClient=client)
+    costexplorer.queueReport(Name='Total', GroupBy=[], Style='Total')
+    costexplorer.queueReport(Name='TotalChange', GroupBy=[], Style='Change')
+    costexplorer.queueReport(Name='TotalInclCredits', GroupBy=[], Style='Total', NoCredits=False)
+    costexplorer.queueReport(Name='Credits', GroupBy=[], Style='Total', CreditsOnly=True)
+    costexplorer.queueReport(Name='RIUpfront', GroupBy=[], Style='Total', UpfrontOnly=True)
+    costexplorer.runQueue()
+
+    assert len(client.requests) == 1, '{0} Cost Explorer requests, expected 1'.format(len(client.requests))
+    for report in costexplorer.reports:
+        data = report['Data']
+        assert list(data.columns) == sorted(RECORD_TYPE_AMOUNTS), '{0}: months {1}'.format(report['Name'], list(data.columns))
+        values = data.loc['Total'].tolist()
+        expected = EXPECTED_TOTALS[report['Name']]
+        assert all(abs(value - want) <= COST_TOLERANCE for value, want in zip(values, expected)), \
+            '{0}: {1}, expected {2}'.format(report['Name'], values, expected)
+
+
+CHECKS = {
+    'eipUploads': check_eip_uploads,
+    'costFusion': check_cost_fusion,
+    'costFilters': check_cost_filters,
+}
+
+
+def run_check(name):
+    # Runs in a fresh process, returns None or the failure
+    try:
+        CHECKS[name]()
+    except Exception:
+        return traceback.format_exc().strip().splitlines()[-1]
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the Lambda handlers against a fake AWS backend.')
+    parser.add_argument('--checks', default=','.join(CHECKS), help='comma separated, default: %(default)s')
+    parser.add_argument('--record', action='store_true', help='record the Cost Explorer responses costFusion replays')
+    parser.add_argument('--live', action='store_true', help='record from the account of the current credentials, not FakeAWS')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            executor.submit(record_cost_explorer, args.live).result()
+        return 0
+
+    names = [name.strip() for name in args.checks.split(',') if name.strip()]
+    unknown = [name for name in names if name not in CHECKS]
+    if unknown:
+        parser.error('unknown check(s): {0}'.format(', '.join(unknown)))
+
+    failed = 0
+    for name in names:
+        # The fake backend hooks botocore for the whole process, so one process per check
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            failure = executor.submit(run_check, name).result()
+        print('{0:<20} {1}'.format(name, 'FAIL ' + failure if failure else 'ok'))
+        failed += bool(failure)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -35,21 +35,37 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "./vendored"))
 
 import boto3
+import collections
 import datetime
+import importlib.util
+import io
+import json
 import logging
-import pandas as pd
+import random
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import Future, ThreadPoolExecutor
 #For date
 from dateutil.relativedelta import relativedelta
-#For email
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import COMMASPACE, formatdate
+#pandas, xlsxwriter and the email modules are imported where they are used, to keep cold starts short
+
+import awsMetrics
+import credentialBroker
 
 #GLOBALS
 SES_REGION = os.environ.get('SES_REGION')
 if not SES_REGION:
     SES_REGION="us-east-1"
+#Workbooks above this are sent as a presigned S3 link, SES refuses raw messages over 10 MB
+#and base64 adds a third
+SES_MAX_ATTACHMENT_BYTES = int(os.environ.get('SES_MAX_ATTACHMENT_BYTES', 7 * 1024 * 1024))
+#Seconds the link should last, SigV4 allows up to 7 days. A link dies with the session token
+#that signed it, so temporary credentials cap it at their remaining lifetime, or at
+#SES_LINK_TEMPORARY_EXPIRY when that is unknown (e.g. the Lambda execution role)
+SES_LINK_EXPIRY = int(os.environ.get('SES_LINK_EXPIRY', 7 * 24 * 3600))
+SES_LINK_TEMPORARY_EXPIRY = int(os.environ.get('SES_LINK_TEMPORARY_EXPIRY', 3600))
 ACCOUNT_LABEL = os.environ.get('ACCOUNT_LABEL')
 if not ACCOUNT_LABEL:
     ACCOUNT_LABEL = 'Email'
@@ -60,31 +76,296 @@ if CURRENT_MONTH == "true":
 else:
     CURRENT_MONTH = False
 
+#Report window, MONTHLY or DAILY over the last MONTHS months
+GRANULARITY = os.environ.get('GRANULARITY', 'MONTHLY')
+MONTHS = int(os.environ.get('MONTHS', 12))
+FRAME_DTYPE = os.environ.get('FRAME_DTYPE') #float32 or float64, default depends on GRANULARITY
+FLOAT32_MAX_AMOUNT = 2 ** 16 #float32 keeps cents up to 2**17, Change reports can double an amount
+
+#Parallel report fetching, Cost Explorer allows ~5 requests per second per account
+CE_WORKERS = int(os.environ.get('CE_WORKERS', 4))
+CE_REQUEST_RATE = float(os.environ.get('CE_REQUEST_RATE', 5))
+CE_MAX_RETRIES = int(os.environ.get('CE_MAX_RETRIES', 6))
+#Incremental cost history, closed months are reused instead of fetched again
+HISTORY_LOCATION = os.environ.get('HISTORY_LOCATION') #s3://bucket/prefix or a local directory
+HISTORY_RECOMPUTE_MONTHS = int(os.environ.get('HISTORY_RECOMPUTE_MONTHS', 1)) #closed months still refetched for late adjustments
+PARQUET = importlib.util.find_spec('pyarrow') is not None #pyarrow is not part of the Lambda runtime
+HISTORY_FORMAT = 'parquet' if PARQUET else 'csv.gz'
+#Columnar export next to the Excel workbook: parquet, csv (gzip) or empty for none
+EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT', '')
+EXPORT_PREFIX = os.environ.get('EXPORT_PREFIX', 'export')
+DEFAULT_GROUPBY = [{"Type": "DIMENSION","Key": "SERVICE"},]
+RECORD_TYPE_GROUP = {"Type": "DIMENSION","Key": "RECORD_TYPE"}
+LINKED_ACCOUNT_GROUP = {"Type": "DIMENSION","Key": "LINKED_ACCOUNT"}
+GROUP_KEY_SEPARATOR = '\x1f' #Joins the keys of multi dimension groups in history records
+
+class TokenBucket:
+    """Shared request rate limit, Rate tokens per second with bursts of up to Burst"""
+    def __init__(self, Rate, Burst=None):
+        self.rate = float(Rate)
+        self.capacity = float(Burst or Rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def periodStarts(start, end, Granularity='MONTHLY'):
+    """ISO dates starting every month (or day, for DAILY) from start up to (not incl.) end"""
+    periods = []
+    if Granularity == 'DAILY':
+        period, step = start, relativedelta(days=+1)
+    else:
+        period, step = start.replace(day=1), relativedelta(months=+1)
+    while period < end:
+        periods.append(period.isoformat())
+        period += step
+    return periods
+
+class CostHistory:
+    """Per account store of monthly Cost Explorer results, kept as one columnar
+    file (report, date, key, amount) in /tmp and persisted to HISTORY_LOCATION,
+    either an s3://bucket/prefix or a local directory. Months before Start have
+    left the report window and are dropped on save.
+    """
+    def __init__(self, Location, Account, Start):
+        self.location = Location.rstrip('/')
+        self.start = Start.isoformat()
+        self.filename = 'cost_history_{0}.{1}'.format(Account, HISTORY_FORMAT)
+        if self.location.startswith('s3://'):
+            self.bucket, _, self.prefix = self.location[len('s3://'):].partition('/')
+            self.path = os.path.join('/tmp', self.filename)
+        else:
+            self.bucket = None
+            self.path = os.path.join(self.location, self.filename)
+        self.lock = threading.Lock()
+        self.monthsStored = 0
+        self.monthsFetched = 0
+        self.records = self.load()
+
+    def key(self):
+        return '/'.join(filter(None, [self.prefix, self.filename]))
+
+    def load(self):
+        import pandas as pd
+        if self.bucket:
+            try:
+                boto3.client('s3').download_file(self.bucket, self.key(), self.path)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    return {}
+                raise
+        if not os.path.exists(self.path):
+            return {}
+        if HISTORY_FORMAT == 'parquet':
+            df = pd.read_parquet(self.path)
+        else:
+            df = pd.read_csv(self.path, keep_default_na=False, dtype={'report': str, 'date': str, 'key': str, 'amount': float})
+        records = {}
+        for definition, group in df.groupby('report', sort=False):
+            records[definition] = list(zip(group['date'], group['key'], group['amount']))
+        return records
+
+    def get(self, definition):
+        with self.lock:
+            return list(self.records.get(definition, []))
+
+    def put(self, definition, records):
+        """Replaces the stored months covered by records"""
+        months = set(r[0] for r in records)
+        with self.lock:
+            kept = [r for r in self.records.get(definition, []) if r[0] not in months]
+            self.records[definition] = kept + list(records)
+
+    def count(self, stored, fetched):
+        with self.lock:
+            self.monthsStored += stored
+            self.monthsFetched += fetched
+
+    def hitRatio(self):
+        total = self.monthsStored + self.monthsFetched
+        return float(self.monthsStored) / total if total else 0.0
+
+    def prune(self):
+        """Drops the records older than the report window"""
+        with self.lock:
+            for definition, records in list(self.records.items()):
+                kept = [r for r in records if r[0] >= self.start]
+                if kept:
+                    self.records[definition] = kept
+                else:
+                    del self.records[definition]
+
+    def save(self):
+        import pandas as pd
+        self.prune()
+        rows = [(definition, date, key, amount) for definition, records in self.records.items() for date, key, amount in records]
+        df = pd.DataFrame(rows, columns=['report', 'date', 'key', 'amount'])
+        df['report'] = df['report'].astype('category')
+        if self.bucket is None and not os.path.isdir(self.location):
+            os.makedirs(self.location)
+        if HISTORY_FORMAT == 'parquet':
+            df.to_parquet(self.path, index=False)
+        else:
+            df.to_csv(self.path, index=False, compression='gzip')
+        if self.bucket:
+            boto3.client('s3').upload_file(self.path, self.bucket, self.key())
+
+def recordTypeFilter(NoCredits=True, CreditsOnly=False, UpfrontOnly=False):
+    """The get_cost_and_usage Filter for the addReport credit flags"""
+    Filter = None
+    if NoCredits:
+        Filter={"Not": {"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund", "Upfront"]}}}
+        if CreditsOnly:
+            Filter={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund"]}}
+        if UpfrontOnly:
+            Filter={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Upfront",]}}
+    return Filter
+
+def recordTypeMatcher(Filter):
+    """Returns a function telling whether a RECORD_TYPE value passes Filter, or
+    None when Filter is anything other than a plain RECORD_TYPE filter.
+    """
+    if not Filter:
+        return lambda recordType: True
+    negate = 'Not' in Filter
+    inner = Filter['Not'] if negate else Filter
+    if len(Filter) != 1 or len(inner) != 1 or inner.get('Dimensions', {}).get('Key') != 'RECORD_TYPE':
+        return None
+    values = set(inner['Dimensions']['Values'])
+    return lambda recordType: (recordType in values) != negate
+
+def sumLastDimension(records, Grouped, Matcher):
+    """Drops the last GroupBy dimension of records, keeping the values of that
+    dimension that pass Matcher. This turns a request grouped by RECORD_TYPE into
+    the same request filtered by record type, or a request grouped by
+    LINKED_ACCOUNT into the request one linked account would have made.
+    """
+    sums = {}
+    for date, key, amount in records:
+        # Every month keeps its row, like Cost Explorer returns it for a filtered request
+        sums.setdefault((date, '' if Grouped else 'Total'), 0.0)
+        if not key:
+            continue
+        group, _, value = key.rpartition(GROUP_KEY_SEPARATOR)
+        if Matcher(value):
+            fusedKey = (date, group if Grouped else 'Total')
+            sums[fusedKey] = sums.get(fusedKey, 0.0) + amount
+    return [(date, key, amount) for (date, key), amount in sums.items()]
+
+def accountIndex(records, Position):
+    """Groups records by the linked account found at dimension Position of their
+    key, in one pass. Returns the records, their dates and {account: records},
+    so each account's split only touches its own rows.
+    """
+    dates = {}
+    accounts = {}
+    for record in records:
+        dates.setdefault(record[0], None)
+        if not record[1]:
+            continue
+        keys = record[1].split(GROUP_KEY_SEPARATOR)
+        accounts.setdefault(keys[Position] if Position < len(keys) else '', []).append(record)
+    return records, list(dates), accounts
+
+def linkExpiry(Credentials, Requested=SES_LINK_EXPIRY):
+    """Seconds a presigned URL signed with Credentials stays valid, at most Requested"""
+    if Credentials is None:
+        return Requested
+    frozen = Credentials.get_frozen_credentials() #refreshes credentials close to expiry first
+    expiry = getattr(Credentials, '_expiry_time', None)
+    if expiry is not None:
+        remaining = (expiry - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        return max(0, min(Requested, int(remaining) - 60))
+    if frozen.token:
+        return min(Requested, SES_LINK_TEMPORARY_EXPIRY)
+    return Requested
+
+def bucketRegion(Bucket):
+    """Region of the S3 bucket, a SigV4 presigned URL only works when signed for it"""
+    region = os.environ.get('S3_BUCKET_REGION')
+    if not region:
+        region = boto3.client('s3').get_bucket_location(Bucket=Bucket)['LocationConstraint'] or 'us-east-1'
+    return 'eu-west-1' if region == 'EU' else region
+
+def changeFrame(df, Periods=1, Percent=False):
+    """Month over month change of a date indexed frame, as a shifted difference
+    over the index. Periods gives an N month rolling delta, Percent the change
+    relative to the earlier month. The first Periods rows have nothing to compare
+    against, so they keep their value (or 0 for Percent).
+    """
+    previous = df.shift(Periods)
+    if Percent:
+        change = (df - previous) / previous.abs() * 100
+        change = change.replace([float('inf'), float('-inf')], float('nan'))
+        return change.fillna(0.0)
+    return (df - previous.fillna(0.0)).fillna(0.0)
+
+def writableValues(data):
+    """The values of a report frame as float64 for the workbook and exports.
+    float32 frames go through their shortest decimal repr, so an amount of 1.1
+    is written as 1.1 and not as 1.100000023841858.
+    """
+    values = data.values
+    if values.dtype == 'float32':
+        return values.astype(str).astype('float64')
+    return values.astype('float64')
+
 class CostExplorer:
     """Retrieves BillingInfo checks from CostExplorer API
     >>> costexplorer = CostExplorer()
     >>> costexplorer.addReport(GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"}])
     >>> costexplorer.generateExcel()
     """
-    def __init__(self, ACCESS_KEY=None, SECRET_KEY=None, SESSION_TOKEN=None, CurrentMonth=False):
+    def __init__(self, ACCESS_KEY=None, SECRET_KEY=None, SESSION_TOKEN=None, CurrentMonth=False, AccountId=None, Client=None, SplitByAccount=False, OrgClient=None, Granularity=GRANULARITY, Months=MONTHS):
         #Array of reports ready to be output to Excel.
         self.reports = []
-        self.client = boto3.client('ce', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, aws_session_token=SESSION_TOKEN, region_name='us-east-1')
+        #Cost Explorer results already fetched this run, keyed on the request.
+        self.cache = {}
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.cacheLock = threading.Lock()
+        #Reads of each cache entry still to come from the queued reports (see planCache).
+        self.cacheUses = collections.Counter()
+        #GroupBy values (as json) answered from one RECORD_TYPE grouped request.
+        self.fused = set()
+        #Payer batch mode, every request is also grouped by LINKED_ACCOUNT (see runAccounts).
+        self.splitByAccount = SplitByAccount
+        #Reports declared with queueReport / queueRiReport, fetched by runQueue.
+        self.queue = []
+        self.limiter = TokenBucket(CE_REQUEST_RATE)
+        self.client = Client or boto3.client('ce', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, aws_session_token=SESSION_TOKEN, region_name='us-east-1')
+        self.granularity = Granularity
+        #float32 halves the memory of long DAILY frames, MONTHLY keeps exact cents
+        self.dtype = FRAME_DTYPE or ('float32' if Granularity == 'DAILY' else 'float64')
         self.end = datetime.date.today().replace(day=1)# - datetime.timedelta(days=1) # last day of last month
         self.riend = datetime.date.today()
         if CurrentMonth or CURRENT_MONTH:
             self.end = self.riend
-        self.start = (datetime.date.today() - relativedelta(months=+12)).replace(day=1) #1st day of month 11 months ago
-        self.ristart = (datetime.date.today() - relativedelta(months=+11)).replace(day=1) #1st day of month 11 months ago
+        self.start = (datetime.date.today() - relativedelta(months=+Months)).replace(day=1) #1st day of month Months ago
+        self.ristart = (datetime.date.today() - relativedelta(months=+(Months-1))).replace(day=1) #1st day of month Months-1 ago
         try:
-            self.accounts = self.getAccounts()
+            self.accounts = self.getAccounts(Client=OrgClient)
         except:
             logging.exception("Getting Account names failed")
             self.accounts = {}
+        self.history = None
+        if HISTORY_LOCATION and AccountId:
+            self.history = CostHistory(HISTORY_LOCATION, AccountId, self.start)
 
-    def getAccounts(self, ACCESS_KEY=None, SECRET_KEY=None, SESSION_TOKEN=None):
+    def getAccounts(self, ACCESS_KEY=None, SECRET_KEY=None, SESSION_TOKEN=None, Client=None):
         accounts = {}
-        client = boto3.client('organizations', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, aws_session_token=SESSION_TOKEN, region_name='us-east-1')
+        client = Client or boto3.client('organizations', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, aws_session_token=SESSION_TOKEN, region_name='us-east-1')
         paginator = client.get_paginator('list_accounts')
         response_iterator = paginator.paginate()
         for response in response_iterator:
@@ -92,153 +373,369 @@ class CostExplorer:
                 accounts[acc['Id']] = acc
         return accounts
 
-    def addRiReport(self, Name="RICoverage"):
-        results = []
-        response = self.client.get_reservation_coverage(
-            TimePeriod={
+    def coverageRequest(self):
+        request = {
+            'TimePeriod': {
                 'Start': self.ristart.isoformat(),
                 'End': self.riend.isoformat()
             },
-            Granularity='MONTHLY'
-        )
-        results.extend(response['CoveragesByTime'])
-        while 'nextToken' in response:
-            nextToken = response['nextToken']
-            response = self.client.get_reservation_coverage(
-                TimePeriod={
-                    'Start': self.ristart.isoformat(),
-                    'End': self.riend.isoformat()
-                },
-                Granularity='MONTHLY',
-                NextPageToken=nextToken
-            )
-            results.extend(response['CoveragesByTime'])
-            if 'nextToken' in response:
-                nextToken = response['nextToken']
-            else:
-                nextToken = False
+            'Granularity': self.granularity
+        }
+        if self.splitByAccount:
+            request['GroupBy'] = [LINKED_ACCOUNT_GROUP]
+        return request
 
-        rows = []
-        for v in response['CoveragesByTime']:
-            row = {'date':v['TimePeriod']['Start']}
-            row.update({'Coverage%':float(v['Total']['CoverageHours']['CoverageHoursPercentage'])})
-            rows.append(row)
+    def riReport(self, Name="RICoverage", Account=None):
+        import pandas as pd
+        request = self.coverageRequest()
+        results = self.cached(json.dumps(request, sort_keys=True), lambda: self.queryCoverage(request))
 
-        df = pd.DataFrame(rows)#index=[i['date'] for i in rows]
-        df.set_index("date", inplace= True)
-        df = df.fillna(0.0)
-        df = df.T
-        self.reports.append({'Name':Name,'Data':df})
-
-
-    def addReport(self, Name="Default",GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"},],
-    Style='Total', NoCredits=True, CreditsOnly=False, UpfrontOnly=False):
-        results = []
-        if not NoCredits:
-            response = self.client.get_cost_and_usage(
-                TimePeriod={
-                    'Start': self.start.isoformat(),
-                    'End': self.end.isoformat()
-                },
-                Granularity='MONTHLY',
-                Metrics=[
-                    'UnblendedCost',
-                ],
-                GroupBy=GroupBy
-            )
-        else:
-            Filter={"Not": {"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund", "Upfront"]}}}
-            if CreditsOnly:
-                Filter={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Credit", "Refund"]}}
-            if UpfrontOnly:
-                Filter={"Dimensions": {"Key": "RECORD_TYPE","Values": ["Upfront",]}}
-            response = self.client.get_cost_and_usage(
-                TimePeriod={
-                    'Start': self.start.isoformat(),
-                    'End': self.end.isoformat()
-                },
-                Granularity='MONTHLY',
-                Metrics=[
-                    'UnblendedCost',
-                ],
-                GroupBy=GroupBy,
-                Filter=Filter
-            )
-
-        if response:
-            results.extend(response['ResultsByTime'])
-
-            while 'nextToken' in response:
-                nextToken = response['nextToken']
-                response = self.client.get_cost_and_usage(
-                    TimePeriod={
-                        'Start': self.start.isoformat(),
-                        'End': self.end.isoformat()
-                    },
-                    Granularity='MONTHLY',
-                    Metrics=[
-                        'UnblendedCost',
-                    ],
-                    GroupBy=GroupBy,
-                    NextPageToken=nextToken
-                )
-                results.extend(response['ResultsByTime'])
-                if 'nextToken' in response:
-                    nextToken = response['nextToken']
-                else:
-                    nextToken = False
-        # Now we should have all records, lets setup a waterfall datagrid
-        #{key:value for (key,value) in dictonary.items()}
         rows = []
         for v in results:
             row = {'date':v['TimePeriod']['Start']}
-            for i in v['Groups']:
-                key = i['Keys'][0]
-                if key in self.accounts:
-                    key = self.accounts[key][ACCOUNT_LABEL]
-                row.update({key:float(i['Metrics']['UnblendedCost']['Amount'])})
-            if not v['Groups']:
-                row.update({'Total':float(v['Total']['UnblendedCost']['Amount'])})
+            if Account:
+                coverage = [i['Coverage'] for i in v.get('Groups', []) if Account in i['Attributes'].values()]
+                row.update({'Coverage%':float(coverage[0]['CoverageHours']['CoverageHoursPercentage']) if coverage else 0.0})
+            else:
+                row.update({'Coverage%':float(v['Total']['CoverageHours']['CoverageHoursPercentage'])})
             rows.append(row)
 
         df = pd.DataFrame(rows)#index=[i['date'] for i in rows]
         df.set_index("date", inplace= True)
         df = df.fillna(0.0)
-
-        if Style == 'Change':
-            dfc = df.copy()
-            lastindex = None
-            for index, row in df.iterrows():
-                if lastindex:
-                    for i in row.index:
-                        try:
-                            df.at[index,i] = dfc.at[index,i] - dfc.at[lastindex,i]
-                        except:
-                            logging.exception("Error")
-                            df.at[index,i] = 0
-                lastindex = index
         df = df.T
+        return {'Name':Name,'Data':df}
+
+    def queryCoverage(self, request):
+        results = []
+        response = self.call(self.client.get_reservation_coverage, **request)
+        results.extend(response['CoveragesByTime'])
+        while response.get('NextPageToken'):
+            response = self.call(self.client.get_reservation_coverage, NextPageToken=response['NextPageToken'], **request)
+            results.extend(response['CoveragesByTime'])
+        return results
 
-        self.reports.append({'Name':Name,'Data':df})
+    def addRiReport(self, Name="RICoverage"):
+        self.reports.append(self.riReport(Name=Name))
+
+    def queueRiReport(self, **kwargs):
+        self.queue.append((self.riReport, kwargs))
+
+    def call(self, method, **kwargs):
+        """Sends one Cost Explorer request through the shared token bucket,
+        backing off and retrying when Cost Explorer throttles us.
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                return method(**kwargs)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in awsMetrics.THROTTLING_ERRORS or attempt >= CE_MAX_RETRIES:
+                    raise
+            attempt += 1
+            time.sleep(min(2 ** attempt * 0.25, 10) * random.uniform(0.5, 1.5))
+
+    def costAndUsage(self, GroupBy=[], Filter=None, Account=None):
+        """Returns the month by group DataFrame for a get_cost_and_usage request.
+        GroupBy values planned for fusion (see planFusion) are answered from one
+        request grouped by RECORD_TYPE, aggregated locally through the Filter.
+        In SplitByAccount mode the request is also grouped by LINKED_ACCOUNT and
+        Account picks the linked account the frame is for.
+        """
+        fetchGroupBy, fetchFilter, matcher = self.fetchPlan(GroupBy, Filter)
+        records = self.cachedRecords(fetchGroupBy, fetchFilter, Account=Account)
+        if matcher:
+            records = sumLastDimension(records, len(fetchGroupBy) > 1, matcher)
+        if Account and self.splitGroupBy(GroupBy) != GroupBy:
+            records = sumLastDimension(records, bool(GroupBy), lambda account: account == Account)
+        return self.recordsToFrame(records)
+
+    def fetchPlan(self, GroupBy, Filter):
+        """The GroupBy and Filter costAndUsage fetches for a report, with the
+        RECORD_TYPE matcher that aggregates fused requests (None otherwise).
+        """
+        fetchGroupBy = self.splitGroupBy(GroupBy)
+        matcher = recordTypeMatcher(Filter)
+        if matcher and json.dumps(GroupBy, sort_keys=True) in self.fused:
+            return fetchGroupBy + [RECORD_TYPE_GROUP], None, matcher
+        return fetchGroupBy, Filter, None
+
+    def splitGroupBy(self, GroupBy):
+        if not self.splitByAccount or LINKED_ACCOUNT_GROUP in GroupBy:
+            return GroupBy
+        return GroupBy + [LINKED_ACCOUNT_GROUP]
+
+    def cachedRecords(self, GroupBy=[], Filter=None, Account=None):
+        """Returns the (date, key, amount) records of a get_cost_and_usage request.
+        Requests grouped by LINKED_ACCOUNT in SplitByAccount mode are cached with
+        their accountIndex, Account then picks that account's records after an
+        empty row per month, so every month keeps its row.
+        """
+        request = self.costRequest(GroupBy, Filter)
+        if not (self.splitByAccount and LINKED_ACCOUNT_GROUP in GroupBy):
+            return self.cached(json.dumps(request, sort_keys=True), lambda: self.fetchCostAndUsage(request))
+        records, dates, accounts = self.cached(json.dumps(request, sort_keys=True),
+            lambda: accountIndex(self.fetchCostAndUsage(request), GroupBy.index(LINKED_ACCOUNT_GROUP)))
+        if Account is None:
+            return records
+        return [(date, '', 0.0) for date in dates] + accounts.get(Account, [])
+
+    def costRequest(self, GroupBy=[], Filter=None):
+        request = {
+            'TimePeriod': {
+                'Start': self.start.isoformat(),
+                'End': self.end.isoformat()
+            },
+            'Granularity': self.granularity,
+            'Metrics': [
+                'UnblendedCost',
+            ],
+            'GroupBy': GroupBy
+        }
+        if Filter:
+            request['Filter'] = Filter
+        return request
+
+    def cached(self, cacheKey, fetch):
+        """Identical requests are only sent to Cost Explorer once per run, later
+        calls are answered from self.cache (see cacheHits / cacheMisses).
+        """
+        # The cache holds a Future per request, so concurrent reports asking for
+        # the same data wait on the first fetch instead of sending it again.
+        with self.cacheLock:
+            entry = self.cache.get(cacheKey)
+            owner = entry is None
+            if owner:
+                entry = self.cache[cacheKey] = Future()
+                self.cacheMisses += 1
+            else:
+                self.cacheHits += 1
+        if not owner:
+            records = entry.result()
+            self.release(cacheKey)
+            return records
 
+        try:
+            records = fetch()
+        except Exception as e:
+            with self.cacheLock:
+                del self.cache[cacheKey]
+            entry.set_exception(e)
+            raise
+        entry.set_result(records)
+        self.release(cacheKey)
+        return records
+
+    def release(self, cacheKey):
+        """Counts one planned read of cacheKey, the entry is dropped after the last"""
+        with self.cacheLock:
+            if cacheKey not in self.cacheUses:
+                return
+            self.cacheUses[cacheKey] -= 1
+            if self.cacheUses[cacheKey] <= 0:
+                del self.cacheUses[cacheKey]
+                self.cache.pop(cacheKey, None)
+
+    def fetchCostAndUsage(self, request):
+        if self.history is None:
+            return self.queryRecords(request)
+
+        # Closed months come from the history store, only the months from the
+        # first missing or still open one onwards are requested again.
+        definition = json.dumps({k: v for k, v in request.items() if k != 'TimePeriod'}, sort_keys=True)
+        months = periodStarts(self.start, self.end, self.granularity)
+        inWindow = set(months)
+        refresh = (datetime.date.today().replace(day=1) - relativedelta(months=HISTORY_RECOMPUTE_MONTHS)).isoformat()
+        stored = self.history.get(definition)
+        storedMonths = set(r[0] for r in stored)
+        missing = [m for m in months if m not in storedMonths or m >= refresh]
+        if not missing:
+            self.history.count(len(months), 0)
+            return [r for r in stored if r[0] in inWindow]
+
+        fetchFrom = missing[0]
+        records = [r for r in stored if r[0] in inWindow and r[0] < fetchFrom]
+        fetchRequest = dict(request, TimePeriod={'Start': fetchFrom, 'End': request['TimePeriod']['End']})
+        fetched = self.queryRecords(fetchRequest)
+        self.history.put(definition, fetched)
+        self.history.count(months.index(fetchFrom), len(months) - months.index(fetchFrom))
+        return records + fetched
+
+    def queryRecords(self, request):
+        """Sends a get_cost_and_usage request, following every page, and returns
+        (date, key, amount) records. Months without groups get an empty key, the
+        keys of multi dimension groups are joined with GROUP_KEY_SEPARATOR.
+        """
+        # Records are taken from each page as it arrives, pages are not kept
+        records = []
+        response = {}
+        while True:
+            if response.get('NextPageToken'):
+                response = self.call(self.client.get_cost_and_usage, NextPageToken=response['NextPageToken'], **request)
+            else:
+                response = self.call(self.client.get_cost_and_usage, **request)
+            for v in response['ResultsByTime']:
+                date = v['TimePeriod']['Start']
+                for i in v['Groups']:
+                    records.append((date, GROUP_KEY_SEPARATOR.join(i['Keys']), float(i['Metrics']['UnblendedCost']['Amount'])))
+                if not v['Groups']:
+                    if 'UnblendedCost' in v['Total']:
+                        records.append((date, 'Total', float(v['Total']['UnblendedCost']['Amount'])))
+                    else:
+                        records.append((date, '', 0.0))
+            if not response.get('NextPageToken'):
+                return records
+
+    def recordsToFrame(self, records):
+        import numpy as np
+        import pandas as pd
+        # Now we should have all records, lets setup a waterfall datagrid.
+        # Dates and keys are turned into integer codes and the amounts written
+        # straight into a typed date x key array (self.dtype), no dict per row.
+        dates = sorted({date for date, key, amount in records})
+        dateCodes = {date: i for i, date in enumerate(dates)}
+        labels = {}
+        first = {}
+        for n, (date, key, amount) in enumerate(records):
+            if key not in labels:
+                label = key.split(GROUP_KEY_SEPARATOR)[0]
+                labels[key] = self.accounts[label][ACCOUNT_LABEL] if label in self.accounts else label
+            label = labels[key]
+            #Columns keep the order in which the keys first show up, month by month
+            if label and (label not in first or dateCodes[date] < first[label][0]):
+                first[label] = (dateCodes[date], n)
+        columns = sorted(first, key=first.get)
+        keyCodes = {label: i for i, label in enumerate(columns)}
+
+        #Months without groups only carry a '' marker, they add their row but no column
+        kept = [n for n, record in enumerate(records) if labels[record[1]]]
+        rows = np.fromiter((dateCodes[records[n][0]] for n in kept), dtype=np.int32, count=len(kept))
+        cols = np.fromiter((keyCodes[labels[records[n][1]]] for n in kept), dtype=np.int32, count=len(kept))
+        amounts = np.fromiter((records[n][2] for n in kept), dtype=np.float64, count=len(kept))
+        dtype = self.dtype
+        #Large amounts would lose their cents in float32, those frames stay float64
+        if dtype == 'float32' and len(amounts) and np.abs(amounts).max() >= FLOAT32_MAX_AMOUNT:
+            dtype = 'float64'
+        grid = np.zeros((len(dates), len(columns)), dtype=dtype)
+        grid[rows, cols] = amounts
+        return pd.DataFrame(grid, index=pd.Index(dates, name='date'), columns=pd.Index(columns, dtype=object))
+
+    def addReport(self, **kwargs):
+        self.reports.append(self.report(**kwargs))
+
+    def queueReport(self, **kwargs):
+        """Declares a report to be fetched later by runQueue, see addReport"""
+        self.queue.append((self.report, kwargs))
+
+    def runQueue(self, Workers=CE_WORKERS):
+        """Fetches every queued report through a bounded thread pool. Reports
+        are added to self.reports in the order they were queued.
+        """
+        self.planFusion()
+        self.planCache(self.queue)
+        with ThreadPoolExecutor(max_workers=max(Workers, 1)) as executor:
+            futures = [executor.submit(method, **kwargs) for method, kwargs in self.queue]
+            self.queue = []
+            for future in futures:
+                self.reports.append(future.result())
+
+    def runAccounts(self, AccountIds, Workers=CE_WORKERS):
+        """SplitByAccount mode: builds the queued reports for every linked account
+        in AccountIds out of the same payer requests. Yields (account id, reports)
+        in AccountIds order, each list in the order the reports were queued.
+        At most Workers accounts are built ahead of the caller, so each workbook
+        can be written and dropped before all accounts are done.
+        """
+        self.planFusion()
+        self.planCache(self.queue, Runs=len(AccountIds))
+        queue, self.queue = self.queue, []
+        workers = max(Workers, 1)
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for account in AccountIds:
+                pending.append((account, [executor.submit(method, Account=account, **kwargs) for method, kwargs in queue]))
+                if len(pending) > workers:
+                    account, reports = pending.popleft()
+                    yield account, [future.result() for future in reports]
+            while pending:
+                account, reports = pending.popleft()
+                yield account, [future.result() for future in reports]
+
+    def planFusion(self):
+        """Finds queued reports that share a GroupBy and only differ in their
+        RECORD_TYPE filter, those are answered from one fused request.
+        """
+        variants = {}
+        for method, kwargs in self.queue:
+            if method != self.report:
+                continue
+            GroupBy = kwargs.get('GroupBy', DEFAULT_GROUPBY)
+            Filter = recordTypeFilter(kwargs.get('NoCredits', True), kwargs.get('CreditsOnly', False), kwargs.get('UpfrontOnly', False))
+            variants.setdefault(json.dumps(GroupBy, sort_keys=True), set()).add(json.dumps(Filter, sort_keys=True))
+        for GroupBy, filters in variants.items():
+            # Cost Explorer allows two GroupBy dimensions, RECORD_TYPE takes one
+            if len(filters) > 1 and len(self.splitGroupBy(json.loads(GroupBy))) < 2:
+                self.fused.add(GroupBy)
+
+    def planCache(self, queue, Runs=1):
+        """Counts the reads the queued reports will make of each cache entry, Runs
+        times over (once per account in runAccounts). The records of a GroupBy
+        are then dropped once its last report is built, not kept for the whole
+        run; entries nobody planned for stay cached.
+        """
+        uses = collections.Counter()
+        for method, kwargs in queue:
+            if method == self.riReport:
+                request = self.coverageRequest()
+            elif method == self.report:
+                Filter = recordTypeFilter(kwargs.get('NoCredits', True), kwargs.get('CreditsOnly', False), kwargs.get('UpfrontOnly', False))
+                GroupBy, Filter, matcher = self.fetchPlan(kwargs.get('GroupBy', DEFAULT_GROUPBY), Filter)
+                request = self.costRequest(GroupBy, Filter)
+            else:
+                continue
+            uses[json.dumps(request, sort_keys=True)] += Runs
+        with self.cacheLock:
+            self.cacheUses.update(uses)
 
-    def generateExcel(self):
-        # Create a Pandas Excel writer using XlsxWriter as the engine.\
-        os.chdir('/tmp')
-        writer = pd.ExcelWriter('cost_explorer_report.xlsx', engine='xlsxwriter')
-        workbook = writer.book
-        for report in self.reports:
-            report['Data'].to_excel(writer, sheet_name=report['Name'])
-            worksheet = writer.sheets[report['Name']]
+    def report(self, Name="Default",GroupBy=DEFAULT_GROUPBY,
+    Style='Total', NoCredits=True, CreditsOnly=False, UpfrontOnly=False, Periods=1, Account=None):
+        Filter = recordTypeFilter(NoCredits, CreditsOnly, UpfrontOnly)
+        df = self.costAndUsage(GroupBy=GroupBy, Filter=Filter, Account=Account)
 
+        if Style == 'Change':
+            df = changeFrame(df, Periods=Periods)
+        if Style == 'PercentChange':
+            df = changeFrame(df, Periods=Periods, Percent=True)
+        df = df.T
 
-            # Create a chart object.
+        return {'Name':Name,'Data':df}
+
+
+    def excelBytes(self, Reports=None):
+        """Renders every report with its chart into an in-memory xlsx workbook.
+        Sheets are written row by row so xlsxwriter can run in constant memory mode.
+        """
+        import xlsxwriter
+        output = io.BytesIO()
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        header = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+        for report in (self.reports if Reports is None else Reports):
+            data = report['Data']
+            worksheet = workbook.add_worksheet(report['Name'])
+            worksheet.write_row(0, 1, [str(c) for c in data.columns], header)
+            for row_num, (key, values) in enumerate(zip(data.index, writableValues(data).tolist()), 1):
+                worksheet.write(row_num, 0, key, header)
+                worksheet.write_row(row_num, 1, values)
+
+            # Create a chart object, xlsxwriter refuses charts without series
+            # (e.g. a linked account with no rows in a batch report).
+            if not len(data):
+                continue
             chart = workbook.add_chart({'type': 'column', 'subtype': 'stacked'})
 
-            chartend=12
-            if CURRENT_MONTH:
-                chartend=13
-            for row_num in range(1, len(report['Data']) + 1):
+            chartend=len(data.columns)
+            for row_num in range(1, len(data) + 1):
                 chart.add_series({
                     'name':       [report['Name'], row_num, 0],
                     'categories': [report['Name'], 0, 1, 0, chartend],
@@ -246,79 +743,234 @@ class CostExplorer:
                 })
 
             worksheet.insert_chart('O2', chart)
-        writer.save()
+        workbook.close()
+        return output.getvalue()
+
+    def exportColumnar(self, CustomerName='', Reports=None, Format=None):
+        """Writes every report as one small file per month under
+        EXPORT_PREFIX/customer=<name>/report=<sheet>/month=<YYYY-MM>/ in S3_BUCKET,
+        so consumers can read just the slices they need. Each file holds the
+        (date, key, value) rows of every period in that month, one date for
+        MONTHLY and every day for DAILY granularity. Parquet falls back to gzip
+        CSV when pyarrow is not available. Returns the number of files written.
+        """
+        import numpy as np
+        import pandas as pd
+        Format = Format or EXPORT_FORMAT
+        if Format == 'parquet' and not PARQUET:
+            logging.warning("pyarrow not available, exporting gzip CSV instead of Parquet")
+            Format = 'csv'
+        extension = 'parquet' if Format == 'parquet' else 'csv.gz'
+        slices = []
+        for report in (self.reports if Reports is None else Reports):
+            data = report['Data']
+            months = {}
+            for date in data.columns:
+                months.setdefault(str(date)[:7], []).append(date)
+            for month, dates in months.items():
+                #Date major rows, the days of a DAILY month share the month's file
+                frame = pd.DataFrame({'date': np.repeat([str(date) for date in dates], len(data.index)),
+                                      'key': np.tile(data.index.astype(str), len(dates)),
+                                      'value': writableValues(data[dates]).T.ravel()})
+                key = '{0}/customer={1}/report={2}/month={3}/data.{4}'.format(
+                    EXPORT_PREFIX, CustomerName, report['Name'], month, extension)
+                slices.append((key, frame))
+
+        def write(item):
+            key, frame = item
+            output = io.BytesIO()
+            if extension == 'parquet':
+                frame.to_parquet(output, index=False)
+            else:
+                frame.to_csv(output, index=False, compression={'method': 'gzip', 'mtime': 0})
+            s3.put_object(Bucket=os.environ.get('S3_BUCKET'), Key=key, Body=output.getvalue())
+
+        s3 = boto3.client('s3')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(write, slices))
+        return len(slices)
 
-        #Time to deliver the file to S3
+    def generateExcel(self, CustomerName='', Reports=None):
+        report = self.excelBytes(Reports)
+        key = None
+
+        #Time to deliver the file to S3, upload_fileobj switches to multipart for large workbooks
         if os.environ.get('S3_BUCKET'):
+            key = CustomerName + '/' + "cost_explorer_report.xlsx"
             s3 = boto3.client('s3')
-            s3.upload_file("cost_explorer_report.xlsx", os.environ.get('S3_BUCKET') + customerName + '/', "cost_explorer_report.xlsx")
+            s3.upload_fileobj(io.BytesIO(report), os.environ.get('S3_BUCKET'), key)
         if os.environ.get('SES_SEND'):
-            #Email logic
-            msg = MIMEMultipart()
-            msg['From'] = os.environ.get('SES_FROM')
-            msg['To'] = COMMASPACE.join(os.environ.get('SES_SEND').split(","))
-            msg['Date'] = formatdate(localtime=True)
-            msg['Subject'] = customerName + "Cost Explorer Report"
-            text = "Find your Cost Explorer report attached\n\n"
-            msg.attach(MIMEText(text))
-            with open("cost_explorer_report.xlsx", "rb") as fil:
-                part = MIMEApplication(
-                    fil.read(),
-                    Name="cost_explorer_report.xlsx"
-                )
-            part['Content-Disposition'] = 'attachment; filename="%s"' % "cost_explorer_report.xlsx"
-            msg.attach(part)
-            #SES Sending
-            ses = boto3.client('ses', region_name=SES_REGION)
-            result = ses.send_raw_email(
-                Source=msg['From'],
-                Destinations=os.environ.get('SES_SEND').split(","),
-                RawMessage={'Data': msg.as_string()}
-            )
-
-
-def main_handler(event, context=None):
+            self.emailReport(CustomerName, report, key)
+
+    def emailReport(self, CustomerName, Report, Key=None):
+        """Sends the workbook as attachment, or above SES_MAX_ATTACHMENT_BYTES as a
+        presigned link to the object uploaded at Key
+        """
+        awsMetrics.count('WorkbookBytes', len(Report), 'Bytes')
+        if len(Report) <= SES_MAX_ATTACHMENT_BYTES:
+            path = 'attachment'
+            message = self.emailMessage(CustomerName, "Find your Cost Explorer report attached\n\n", Report)
+        elif Key:
+            #Signed locally in the bucket's region, for no longer than the signing credentials last
+            bucket = os.environ.get('S3_BUCKET')
+            session = boto3.session.Session()
+            expiresIn = linkExpiry(session.get_credentials())
+            expiresAt = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expiresIn)
+            #Virtual host addressing gives the regional host, the global one redirects outside us-east-1
+            s3 = session.client('s3', region_name=bucketRegion(bucket), config=Config(s3={'addressing_style': 'virtual'}))
+            url = s3.generate_presigned_url('get_object', ExpiresIn=expiresIn,
+                Params={'Bucket': bucket, 'Key': Key})
+            path = 'link'
+            message = self.emailMessage(CustomerName, "Your Cost Explorer report ({0:.1f} MB) is too large to attach, download it before {1} UTC from:\n\n{2}\n\n".format(
+                len(Report) / 1024.0 / 1024.0, expiresAt.strftime('%Y-%m-%d %H:%M'), url))
+            awsMetrics.gauge('EmailLinkExpiry', expiresIn, 'Seconds')
+        else:
+            print('SES delivery: skipped, workbook {0} bytes is over {1} and there is no S3_BUCKET to link to'.format(
+                len(Report), SES_MAX_ATTACHMENT_BYTES))
+            return
+        #SES Sending
+        ses = boto3.client('ses', region_name=SES_REGION)
+        ses.send_raw_email(
+            Source=os.environ.get('SES_FROM'),
+            Destinations=os.environ.get('SES_SEND').split(","),
+            RawMessage={'Data': message}
+        )
+        awsMetrics.count('EmailsSentAs' + path.capitalize())
+        awsMetrics.count('EmailBytes', len(message), 'Bytes')
+
+    def emailMessage(self, CustomerName, Text, Attachment=None):
+        """Raw MIME message for send_raw_email. The attachment is base64 encoded once
+        straight into the message bytes, instead of copying it through the email
+        package and msg.as_string()
+        """
+        import base64
+        import uuid
+        from email.header import Header
+        from email.utils import COMMASPACE, formatdate
+        boundary = '==============={0}=='.format(uuid.uuid4().hex)
+        head = '\n'.join([
+            'Content-Type: multipart/mixed; boundary="{0}"'.format(boundary),
+            'MIME-Version: 1.0',
+            'From: ' + os.environ.get('SES_FROM'),
+            'To: ' + COMMASPACE.join(os.environ.get('SES_SEND').split(",")),
+            'Date: ' + formatdate(localtime=True),
+            'Subject: ' + Header(CustomerName + "Cost Explorer Report", 'utf-8').encode(),
+            '',
+            '--' + boundary,
+            'Content-Type: text/plain; charset="utf-8"',
+            'Content-Transfer-Encoding: 8bit',
+            '',
+            Text,
+        ])
+        message = io.BytesIO()
+        message.write(head.encode('utf-8'))
+        if Attachment is not None:
+            message.write('\n'.join([
+                '--' + boundary,
+                'Content-Type: application/vnd.openxmlformats-officedocument.spreadsheetml.sheet; name="cost_explorer_report.xlsx"',
+                'Content-Transfer-Encoding: base64',
+                'Content-Disposition: attachment; filename="cost_explorer_report.xlsx"',
+                '', '']).encode('ascii'))
+            #Chunks of whole 57 byte input lines encode to complete 76 character lines
+            chunk = 57 * 1024
+            view = memoryview(Attachment)
+            for offset in range(0, len(view), chunk):
+                message.write(base64.encodebytes(view[offset:offset + chunk]))
+        message.write('--{0}--\n'.format(boundary).encode('ascii'))
+        return message.getvalue()
+
+
+def recordMetrics(costexplorer):
+    """Cache and cost history figures for the invocation's metrics summary"""
+    awsMetrics.count('Reports', len(costexplorer.reports))
+    awsMetrics.count('CacheHits', costexplorer.cacheHits)
+    awsMetrics.count('CacheMisses', costexplorer.cacheMisses)
+    if costexplorer.history:
+        awsMetrics.count('HistoryMonthsReused', costexplorer.history.monthsStored)
+        awsMetrics.count('HistoryMonthsFetched', costexplorer.history.monthsFetched)
+        awsMetrics.gauge('HistoryHitRatio', round(costexplorer.history.hitRatio() * 100, 1), 'Percent')
+
+def queueReports(costexplorer):
+    """Declares the report suite shared by main_handler and batch_handler"""
+    #Default addReport has filter to remove Credits / Refunds / UpfrontRI
+    costexplorer.queueReport(Name="Total", GroupBy=[],Style='Total')
+    costexplorer.queueReport(Name="TotalChange", GroupBy=[],Style='Change')
+    costexplorer.queueReport(Name="TotalInclCredits", GroupBy=[],Style='Total',NoCredits=False)
+    costexplorer.queueReport(Name="TotalInclCreditsChange", GroupBy=[],Style='Change',NoCredits=False)
+    costexplorer.queueReport(Name="Credits", GroupBy=[],Style='Total',CreditsOnly=True)
+    costexplorer.queueReport(Name="RIUpfront", GroupBy=[],Style='Total',UpfrontOnly=True)
+
+    costexplorer.queueRiReport(Name="RICoverage")
+    costexplorer.queueReport(Name="Services", GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"}],Style='Total')
+    costexplorer.queueReport(Name="ServicesChange", GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"}],Style='Change')
+    costexplorer.queueReport(Name="Accounts", GroupBy=[{"Type": "DIMENSION","Key": "LINKED_ACCOUNT"}],Style='Total')
+    costexplorer.queueReport(Name="AccountsChange", GroupBy=[{"Type": "DIMENSION","Key": "LINKED_ACCOUNT"}],Style='Change')
+    costexplorer.queueReport(Name="Regions", GroupBy=[{"Type": "DIMENSION","Key": "REGION"}],Style='Total')
+    costexplorer.queueReport(Name="RegionsChange", GroupBy=[{"Type": "DIMENSION","Key": "REGION"}],Style='Change')
+    if os.environ.get('COST_TAGS'): #Support for multiple/different Cost Allocation tags
+        for tagkey in os.environ.get('COST_TAGS').split(','):
+            tabname = tagkey.replace(":",".") #Remove special chars from Excel tabname
+            costexplorer.queueReport(Name="{}".format(tabname)[:31], GroupBy=[{"Type": "TAG","Key": tagkey}],Style='Total')
+            costexplorer.queueReport(Name="Change-{}".format(tabname)[:31], GroupBy=[{"Type": "TAG","Key": tagkey}],Style='Change')
+
+@awsMetrics.instrumented('createCostExplorerReport')
+def main_handler(event=None, context=None):
     # -----------------------------------------------------------------------
-    # initiating a session using ARN of the IAM role
+    # cross-account IAM role, assumed (or reused from a warm container) by credentialBroker.
+    # Without an ARN (local runs) the report is made with the default credentials.
     # -----------------------------------------------------------------------
-    stsclient = boto3.client('sts')
-    rolearn = event['ARN']
-    roleExternalId = event['externalId']
-    awsaccount = stsclient.assume_role(
-        RoleArn=rolearn,
-        ExternalId=roleExternalId,
-        RoleSessionName='awsaccount_session'
-    )
-    ACCESS_KEY = awsaccount['Credentials']['AccessKeyId']
-    SECRET_KEY = awsaccount['Credentials']['SecretAccessKey']
-    SESSION_TOKEN = awsaccount['Credentials']['SessionToken']
+    event = event or {}
+    client, awsaccountid = None, None
+    if event.get('ARN'):
+        client = credentialBroker.get_client(event['ARN'], event['externalId'], 'ce', 'us-east-1')
+        awsaccountid = event['ARN'].split(':')[4] # getting awsaccount ID from IAM Role ARN
     # ------------------------------------------------------------------------
     # get friendly name of customer
     # ------------------------------------------------------------------------
-    customerName = event['customerName']
-    costexplorer = CostExplorer(ACCESS_KEY=ACCESS_KEY, SECRET_KEY=SECRET_KEY, SESSION_TOKEN=SESSION_TOKEN, CurrentMonth=False)
-    #Default addReport has filter to remove Credits / Refunds / UpfrontRI
-    costexplorer.addReport(Name="Total", GroupBy=[],Style='Total')
-    costexplorer.addReport(Name="TotalChange", GroupBy=[],Style='Change')
-    costexplorer.addReport(Name="TotalInclCredits", GroupBy=[],Style='Total',NoCredits=False)
-    costexplorer.addReport(Name="TotalInclCreditsChange", GroupBy=[],Style='Change',NoCredits=False)
-    costexplorer.addReport(Name="Credits", GroupBy=[],Style='Total',CreditsOnly=True)
-    costexplorer.addReport(Name="RIUpfront", GroupBy=[],Style='Total',UpfrontOnly=True)
-
-    costexplorer.addRiReport(Name="RICoverage")
-    costexplorer.addReport(Name="Services", GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"}],Style='Total')
-    costexplorer.addReport(Name="ServicesChange", GroupBy=[{"Type": "DIMENSION","Key": "SERVICE"}],Style='Change')
-    costexplorer.addReport(Name="Accounts", GroupBy=[{"Type": "DIMENSION","Key": "LINKED_ACCOUNT"}],Style='Total')
-    costexplorer.addReport(Name="AccountsChange", GroupBy=[{"Type": "DIMENSION","Key": "LINKED_ACCOUNT"}],Style='Change')
-    costexplorer.addReport(Name="Regions", GroupBy=[{"Type": "DIMENSION","Key": "REGION"}],Style='Total')
-    costexplorer.addReport(Name="RegionsChange", GroupBy=[{"Type": "DIMENSION","Key": "REGION"}],Style='Change')
-    if os.environ.get('COST_TAGS'): #Support for multiple/different Cost Allocation tags
-        for tagkey in os.environ.get('COST_TAGS').split(','):
-            tabname = tagkey.replace(":",".") #Remove special chars from Excel tabname
-            costexplorer.addReport(Name="{}".format(tabname)[:31], GroupBy=[{"Type": "TAG","Key": tagkey}],Style='Total')
-            costexplorer.addReport(Name="Change-{}".format(tabname)[:31], GroupBy=[{"Type": "TAG","Key": tagkey}],Style='Change')
-    costexplorer.generateExcel()
+    customerName = event.get('customerName', '')
+    costexplorer = CostExplorer(Client=client, CurrentMonth=False, AccountId=awsaccountid)
+    queueReports(costexplorer)
+    costexplorer.runQueue()
+    if costexplorer.history:
+        costexplorer.history.save()
+    costexplorer.generateExcel(CustomerName=customerName)
+    if (event.get('export') or EXPORT_FORMAT) and os.environ.get('S3_BUCKET'):
+        costexplorer.exportColumnar(CustomerName=customerName, Format=event.get('export'))
+    recordMetrics(costexplorer)
     return "Report Generated"
 
+@awsMetrics.instrumented('createCostExplorerBatch')
+def batch_handler(event=None, context=None):
+    # -----------------------------------------------------------------------
+    # Organization wide run from the payer account, the report suite is fetched
+    # once grouped by LINKED_ACCOUNT and split into one workbook per customer.
+    # event may list 'accounts' (ids), by default every account in the organization.
+    # Customer names come from the getAccounts name map (ACCOUNT_LABEL).
+    # -----------------------------------------------------------------------
+    event = event or {}
+    client, orgClient, payerAccountId = None, None, None
+    if event.get('ARN'):
+        client = credentialBroker.get_client(event['ARN'], event['externalId'], 'ce', 'us-east-1')
+        orgClient = credentialBroker.get_client(event['ARN'], event['externalId'], 'organizations', 'us-east-1')
+        payerAccountId = event['ARN'].split(':')[4]
+    costexplorer = CostExplorer(Client=client, OrgClient=orgClient, CurrentMonth=False, AccountId=payerAccountId, SplitByAccount=True)
+    accountIds = event.get('accounts') or sorted(costexplorer.accounts)
+    if not accountIds:
+        #getAccounts failures are only logged by CostExplorer, a batch without accounts is not a success
+        raise RuntimeError('No accounts to report on: none in the event and the organization listing failed or is empty')
+    queueReports(costexplorer)
+    for accountId, reports in costexplorer.runAccounts(accountIds):
+        #Each workbook is written as its account is done, its reports are dropped after
+        customerName = costexplorer.accounts.get(accountId, {}).get(ACCOUNT_LABEL, accountId)
+        costexplorer.generateExcel(CustomerName=customerName, Reports=reports)
+        if (event.get('export') or EXPORT_FORMAT) and os.environ.get('S3_BUCKET'):
+            costexplorer.exportColumnar(CustomerName=customerName, Reports=reports, Format=event.get('export'))
+    if costexplorer.history:
+        costexplorer.history.save()
+    awsMetrics.count('Accounts', len(accountIds))
+    recordMetrics(costexplorer)
+    return "{0} Reports Generated".format(len(accountIds))
+
 if __name__ == '__main__':
-    main_handler()
+    #Optional event as JSON, e.g. '{"ARN": "...", "externalId": "...", "customerName": "..."}'
+    main_handler(json.loads(sys.argv[1]) if len(sys.argv) > 1 else {})
@@ -0,0 +1,86 @@
+# -----------------------------------------------------------------------------
+# Assumed-role sessions shared by the child Lambda functions.
+# get_session(ARN, externalId) returns a boto3 Session for the cross-account role.
+# The session is cached per (ARN, externalId) for as long as the container stays
+# warm. It uses botocore's refreshable credentials, so it assumes the role again
+# on its own shortly before the credentials expire, and clients made from it keep
+# their connection pools across regions and invocations.
+# get_default_client does the same for the function's own credentials.
+# -----------------------------------------------------------------------------
+
+import boto3
+import os
+import threading
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session as get_botocore_session
+
+ROLE_SESSION_NAME = os.environ.get('ROLE_SESSION_NAME', 'awsaccount_session')
+ROLE_DURATION_SECONDS = int(os.environ.get('ROLE_DURATION_SECONDS', 3600))
+
+_sessions = {}
+_clients = {}
+_lock = threading.Lock()
+_sts = None
+
+
+def _assume_role(role_arn, external_id):
+    global _sts
+    if _sts is None:
+        _sts = boto3.client('sts')
+    credentials = _sts.assume_role(
+        RoleArn=role_arn,
+        ExternalId=external_id,
+        RoleSessionName=ROLE_SESSION_NAME,
+        DurationSeconds=ROLE_DURATION_SECONDS
+    )['Credentials']
+    return {
+        'access_key': credentials['AccessKeyId'],
+        'secret_key': credentials['SecretAccessKey'],
+        'token': credentials['SessionToken'],
+        'expiry_time': credentials['Expiration'].isoformat(),
+    }
+
+
+def get_session(role_arn, external_id):
+    # -------------------------------------------------------------------------
+    # Returns the cached boto3 Session for the role, assuming it on first use.
+    # role_arn None is the default session of the function's own credentials.
+    # -------------------------------------------------------------------------
+    key = (role_arn, external_id)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None and role_arn is None:
+            # The function's own credentials, from the environment
+            session = _sessions[key] = boto3.session.Session()
+        elif session is None:
+            credentials = RefreshableCredentials.create_from_metadata(
+                metadata=_assume_role(role_arn, external_id),
+                refresh_using=lambda: _assume_role(role_arn, external_id),
+                method='sts-assume-role'
+            )
+            botocore_session = get_botocore_session()
+            botocore_session._credentials = credentials
+            session = _sessions[key] = boto3.session.Session(botocore_session=botocore_session)
+        return session
+
+
+def get_client(role_arn, external_id, service_name, region_name=None):
+    # -------------------------------------------------------------------------
+    # Returns a cached client of the role's session, clients are thread safe once
+    # created but creating them from one session is not, hence the lock.
+    # -------------------------------------------------------------------------
+    key = (role_arn, external_id, service_name, region_name)
+    with _lock:
+        client = _clients.get(key)
+    if client is None:
+        session = get_session(role_arn, external_id)
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = session.client(service_name, region_name=region_name)
+    return client
+
+
+def get_default_client(service_name, region_name=None):
+    # Cached client of the function's own credentials, see get_client
+    return get_client(None, None, service_name, region_name)
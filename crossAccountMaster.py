@@ -6,46 +6,107 @@
 
 import boto3
 import json
+import os
+import random
+import time
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-client = boto3.client('lambda')
+import awsMetrics
+
+# Child Lambda functions invoked for every account, comma separated
+CHILD_FUNCTIONS = os.environ.get('CHILD_FUNCTIONS', 'createCostExplorerReport,getOrphanEIPs').split(',')
+INVOKE_WORKERS = int(os.environ.get('INVOKE_WORKERS', 16))  # Concurrent Invoke calls
+INVOKE_MAX_RETRIES = int(os.environ.get('INVOKE_MAX_RETRIES', 4))
+
+# One pooled connection per invoke worker, botocore keeps 10 by default
+client = boto3.client('lambda', config=Config(max_pool_connections=INVOKE_WORKERS))
 ssm_client = boto3.client('ssm')
 
-def lambda_handler(event, context):
 
+def invoke_child(function_name, payload):
     # ----------------------------------------------------------------------------------
-    # Get the list of ARNs of cross-account IAM roles saved in SSM Parameter crossAccountRoleARNList
-    # ----------------------------------------------------------------------------------
-    rolearnlist = []
-    rolearnlist_from_ssm = ssm_client.get_parameter(Name='crossAccountRoleARNList')
-    rolearnlist_from_ssm_list = rolearnlist_from_ssm['Parameter']['Value'].split(",")
-    rolearnlist = rolearnlist_from_ssm_list
-    # ----------------------------------------------------------------------------------
-    # Get the list of External IDs of cross-account IAM roles saved in SSM Parameter crossAccountExternalIDList
-    # ----------------------------------------------------------------------------------
-    externalidlist = []
-    externalidlist_from_ssm = ssm_client.get_parameter(Name='crossAccountExternalIDList')
-    externalidlist_from_ssm_list = externalidlist_from_ssm['Parameter']['Value'].split(",")
-    externalidlist = externalidlist_from_ssm_list
-    # ----------------------------------------------------------------------------------
-    # Get the list of friendly AWS Account Names ('accounting', 'hr', 'development', etc.) for the cross-account IAM roles saved in SSM crossAccountCustomerNameList
+    # Asynchronously invoke one child function, retrying with backoff when throttled,
+    # on server errors and on connection errors.
+    # Returns (function name, latency in seconds, throttled retries, error or None)
     # ----------------------------------------------------------------------------------
-    customernamelist = []
-    customernamelist_from_ssm = ssm_client.get_parameter(Name='crossAccountCustomerNameList')
-    customernamelist_from_ssm_list = customernamelist_from_ssm['Parameter']['Value'].split(",")
-    customernamelist = customernamelist_from_ssm_list
+    throttled = 0
+    started = time.monotonic()
+    for attempt in range(INVOKE_MAX_RETRIES + 1):
+        try:
+            client.invoke(FunctionName=function_name,
+                          InvocationType='Event',
+                          Payload=payload)
+            return function_name, time.monotonic() - started, throttled, None
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in awsMetrics.THROTTLING_ERRORS:
+                throttled += 1
+            elif e.response['ResponseMetadata'].get('HTTPStatusCode', 0) < 500:
+                return function_name, time.monotonic() - started, throttled, code
+            if attempt == INVOKE_MAX_RETRIES:
+                return function_name, time.monotonic() - started, throttled, code
+        except BotoCoreError as e:
+            # Connection errors and timeouts, retried like a 5xx
+            if attempt == INVOKE_MAX_RETRIES:
+                return function_name, time.monotonic() - started, throttled, type(e).__name__
+        time.sleep(min(0.2 * 2 ** attempt, 5) * random.uniform(0.5, 1.5))
+
+
+def get_accounts():
     # ----------------------------------------------------------------------------------
-    # Loop through the list of ARNs and External IDs, asynchronously invoke slave lambda functions, passing ARN
+    # Get the lists saved in SSM in one call:
+    #   crossAccountRoleARNList      - ARNs of cross-account IAM roles
+    #   crossAccountExternalIDList   - External IDs of cross-account IAM roles
+    #   crossAccountCustomerNameList - friendly AWS Account Names ('accounting', 'hr', 'development', etc.)
+    # Returns one child event (ARN, externalId, customerName) per account.
     # ----------------------------------------------------------------------------------
-    for account in range(len(rolearnlist)):
-        currentAccount = {"ARN": rolearnlist[account], "externalId": externalidlist[account], "customerName": customernamelist[account]}
+    parameters = ssm_client.get_parameters(Names=['crossAccountRoleARNList', 'crossAccountExternalIDList', 'crossAccountCustomerNameList'])
+    if parameters['InvalidParameters']:
+        raise ValueError('Missing SSM parameters: {0}'.format(', '.join(parameters['InvalidParameters'])))
+    values = {p['Name']: p['Value'].split(",") for p in parameters['Parameters']}
+    lengths = {name: len(value) for name, value in values.items()}
+    if len(set(lengths.values())) > 1:
+        raise ValueError('SSM account lists differ in length: {0}'.format(
+            ', '.join('{0} {1}'.format(name, length) for name, length in sorted(lengths.items()))))
+    return [{"ARN": arn, "externalId": external_id, "customerName": customer_name}
+            for arn, external_id, customer_name in zip(values['crossAccountRoleARNList'],
+                                                       values['crossAccountExternalIDList'],
+                                                       values['crossAccountCustomerNameList'])]
+
+
+@awsMetrics.instrumented('crossAccountMaster')
+def lambda_handler(event, context):
+
     # ----------------------------------------------------------------------------------
-    # Invoke child lambda scripts against each account in the SSM list
+    # Loop through the accounts listed in SSM, asynchronously invoke child lambda functions
+    # against each account, passing ARN, External ID and customer name
     # ----------------------------------------------------------------------------------
-        invoke_response = client.invoke(FunctionName="createCostExplorerReport",
-                                        InvocationType='Event',
-                                        Payload=json.dumps(currentAccount))
-        print(invoke_response)
-        invoke_response = client.invoke(FunctionName="getOrphanEIPs",
-                                        InvocationType='Event',
-                                        Payload=json.dumps(currentAccount))
-        print(invoke_response)
+    accounts = get_accounts()
+    latencies = []
+    dispatched = 0
+    failed = 0
+    throttled = 0
+    with ThreadPoolExecutor(max_workers=INVOKE_WORKERS) as executor:
+        futures = []
+        for currentAccount in accounts:
+            payload = json.dumps(currentAccount)
+            for function_name in CHILD_FUNCTIONS:
+                futures.append(executor.submit(invoke_child, function_name, payload))
+        for future in as_completed(futures):
+            function_name, latency, retries, error = future.result()
+            latencies.append(latency)
+            throttled += retries
+            if error:
+                failed += 1
+                print('Invoke of {0} failed: {1}'.format(function_name, error))
+            else:
+                dispatched += 1
+
+    awsMetrics.count('Accounts', len(accounts))
+    awsMetrics.count('InvokesDispatched', dispatched)
+    awsMetrics.count('InvokesFailed', failed)
+    awsMetrics.count('InvokesThrottled', throttled)
+    awsMetrics.gauge('InvokeLatencyP50', round(awsMetrics.percentile(latencies, 50) * 1000), 'Milliseconds')
+    awsMetrics.gauge('InvokeLatencyP99', round(awsMetrics.percentile(latencies, 99) * 1000), 'Milliseconds')
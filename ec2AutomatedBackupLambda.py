@@ -5,130 +5,287 @@
 import boto3
 import collections
 import datetime
+import json
+import os
 import time
 import sys
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
-today = datetime.date.today()
-today_string = today.strftime('%Y/%m/%d')
-delete_after_days = 2  # Delete snapshots after this many days
+import awsMetrics
+import awsRegions
+import credentialBroker
 
-# Except after Monday (at Tuesday ~1am), since Friday is only 2 'working' days away:
-if datetime.date.today().weekday() == 1:
-    delete_after_days = delete_after_days + 2
+BackupDates = collections.namedtuple('BackupDates', ['today_string', 'deletion_date', 'delete_after_days'])
+# One tagged instance of the region's backup plan, volumes are (volume id, size in GB) pairs
+InstancePlan = collections.namedtuple('InstancePlan', ['instance_id', 'name', 'owner', 'application', 'state', 'volumes'])
 
-deletion_date = today - datetime.timedelta(days=delete_after_days)
-deletion_date_string = deletion_date.strftime('%Y/%m/%d')
 
+def backup_dates(today=None):
+    # Computed per invocation, a warm container can outlive the day it started on
+    today = today or datetime.date.today()
+    delete_after_days = 2  # Delete snapshots after this many days
 
-ec2 = boto3.client('ec2')
-regions = ec2.describe_regions().get('Regions', [])
-all_regions = [region['RegionName'] for region in regions]
+    # Except after Monday (at Tuesday ~1am), since Friday is only 2 'working' days away:
+    if today.weekday() == 1:
+        delete_after_days = delete_after_days + 2
 
+    deletion_date = today - datetime.timedelta(days=delete_after_days)
+    return BackupDates(today.strftime('%Y/%m/%d'), deletion_date, delete_after_days)
 
+DELETE_WORKERS = int(os.environ.get('DELETE_WORKERS', 4))  # Concurrent DeleteSnapshot calls
+DRY_RUN = os.environ.get('DRY_RUN') == 'true'  # Only report what the retention sweep would delete
+REGION_WORKERS = int(os.environ.get('REGION_WORKERS', 4))  # Regions backed up concurrently
+# 'instance' snapshots all volumes of an instance with one CreateSnapshots call,
+# 'volume' makes one CreateSnapshot call per volume
+SNAPSHOT_MODE = os.environ.get('SNAPSHOT_MODE', 'instance')
+# Stop starting new work when less than this is left of the Lambda timeout and
+# re-invoke the function with a checkpoint, at most MAX_RESUMES times per backup day
+TIME_BUFFER_MS = int(os.environ.get('TIME_BUFFER_MS', 60000))
+MAX_RESUMES = int(os.environ.get('MAX_RESUMES', 10))
+VOLUME_BATCH = 200  # Volume ids per DescribeVolumes call, the most one filter takes
+
+
+def list_snapshots(ec2client):
+    # -------------------------------------------------------------------------
+    # List the lambda_snapshot snapshots we own once and index them by volume,
+    # as (CreatedOn date, snapshot) pairs
+    # -------------------------------------------------------------------------
+    by_volume = collections.defaultdict(list)
+    paginator = ec2client.get_paginator('describe_snapshots')
+    for page in paginator.paginate(OwnerIds=['self'], Filters=[{'Name': 'tag:lambda_snapshot', 'Values': ['true']}]):
+        for snap in page['Snapshots']:
+            tags = {tag['Key']: tag['Value'] for tag in snap.get('Tags', [])}
+            if 'CreatedOn' not in tags:
+                continue
+            created_on = datetime.datetime.strptime(tags['CreatedOn'], '%Y/%m/%d').date()
+            by_volume[tags.get('volume', snap['VolumeId'])].append((created_on, snap))
+    return by_volume
+
+
+def sweep_snapshots(ec2client, region_name, dates, dry_run=False, by_volume=None):
+    # -------------------------------------------------------------------------
+    # Delete every lambda_snapshot snapshot older than the retention period,
+    # by_volume is the list_snapshots index when the caller already has it.
+    # Returns the number of snapshots and GB deleted (or that would be, on a dry run).
+    # -------------------------------------------------------------------------
+    if by_volume is None:
+        by_volume = list_snapshots(ec2client)
+
+    expired = [(created_on, snap) for snaps in by_volume.values() for created_on, snap in snaps if created_on <= dates.deletion_date]
+    awsMetrics.count('SnapshotsChecked', sum(len(snaps) for snaps in by_volume.values()))
+    awsMetrics.count('SnapshotsExpired', len(expired))
+    if dry_run:
+        for created_on, snap in expired:
+            print('Snapshot id {0} from {1} would be deleted'.format(snap['SnapshotId'], created_on.strftime('%Y/%m/%d')))
+        return len(expired), sum(snap['VolumeSize'] for created_on, snap in expired)
+
+    def delete(snap):
+        try:
+            ec2client.delete_snapshot(SnapshotId=snap['SnapshotId'])
+            return snap['VolumeSize']
+        except ClientError as e:
+            print('Could not delete snapshot id {0}: {1}'.format(snap['SnapshotId'], e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        sizes = [size for size in executor.map(delete, [snap for created_on, snap in expired]) if size is not None]
+    return len(sizes), sum(sizes)
+
+
+def snapshot_tags(name, owner, application, dates, volume_id=None):
+    # Tags added to every new snapshot, the volume tag is only known per volume
+    tags = [
+        {
+            'Key': 'lambda_snapshot',
+            'Value': 'true'
+        },
+        {
+            'Key': 'CreatedOn',
+            'Value': dates.today_string
+        },
+        {
+            'Key': 'Name',
+            'Value': '{} backup'.format(name)
+        },
+        {
+            'Key': 'owner',
+            'Value': owner
+        },
+        {
+            'Key': 'application',
+            'Value': application
+        }
+    ]
+    if volume_id:
+        tags.insert(1, {'Key': 'volume', 'Value': volume_id})
+    return tags
+
+
+def inventory(ec2client):
+    # -------------------------------------------------------------------------
+    # One pass over the region: the backup=true instances from paginated
+    # DescribeInstances, their EBS volumes from the block device mappings and
+    # the volume sizes from DescribeVolumes, VOLUME_BATCH volumes per call.
+    # Returns the plan the snapshot stage works through.
+    # -------------------------------------------------------------------------
+    instances = []
+    paginator = ec2client.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[{'Name': 'tag:backup', 'Values': ['true']}], PaginationConfig={'PageSize': 1000}):
+        for reservation in page['Reservations']:
+            for i in reservation['Instances']:
+                tags = {tag['Key']: tag['Value'] for tag in i.get('Tags', [])}
+                volume_ids = [mapping['Ebs']['VolumeId'] for mapping in i.get('BlockDeviceMappings', []) if 'Ebs' in mapping]
+                instances.append((i['InstanceId'], tags, i['State']['Name'], volume_ids))
+
+    sizes = {}
+    volume_ids = [volume_id for instance in instances for volume_id in instance[3]]
+    paginator = ec2client.get_paginator('describe_volumes')
+    for start in range(0, len(volume_ids), VOLUME_BATCH):
+        for page in paginator.paginate(Filters=[{'Name': 'volume-id', 'Values': volume_ids[start:start + VOLUME_BATCH]}]):
+            for volume in page['Volumes']:
+                sizes[volume['VolumeId']] = volume['Size']
+
+    return [InstancePlan(instance_id, tags.get('Name', instance_id), tags.get('owner', ''), tags.get('application', ''), state,
+                         tuple((volume_id, sizes.get(volume_id, 0)) for volume_id in volume_ids))
+            for instance_id, tags, state, volume_ids in instances]
+
+
+def backup_region(region_name, dates, dry_run=False, done_instances=(), out_of_time=lambda: False):
+    # -------------------------------------------------------------------------
+    # Snapshot every volume in the region's inventory plan, then sweep
+    # expired snapshots. Volumes which already have a snapshot CreatedOn today
+    # are skipped, so a resumed or repeated run never snapshots a volume twice
+    # a day. Instances in done_instances were finished by an earlier invocation.
+    # Stops before the next instance (or the sweep) once out_of_time() is true.
+    # Returns the counters for the summary line, the ids of the instances done
+    # and whether the region is complete.
+    # -------------------------------------------------------------------------
+    counters = collections.Counter()
+    done = list(done_instances)
+    if out_of_time():
+        return counters, done, False
+    ec2client = credentialBroker.get_default_client('ec2', region_name)
+
+    # Today's snapshots make the backup idempotent, the same listing feeds the sweep
+    by_volume = list_snapshots(ec2client)
+    today = datetime.datetime.strptime(dates.today_string, '%Y/%m/%d').date()
+    snapshotted_today = set(volume_id for volume_id, snaps in by_volume.items()
+                            if any(created_on == today for created_on, snap in snaps))
+
+    plan = inventory(ec2client)
+    awsMetrics.count('InstancesPlanned', len(plan))
+    awsMetrics.count('VolumesPlanned', sum(len(i.volumes) for i in plan))
+    awsMetrics.count('PlannedGB', sum(size for i in plan for volume_id, size in i.volumes), 'Gigabytes')
+
+    finished = set(done_instances)
+    for i in plan:
+        if i.instance_id in finished:
+            continue
+        if out_of_time():
+            return counters, done, False
+
+        pending = [(volume_id, size) for volume_id, size in i.volumes if volume_id not in snapshotted_today]
+        counters['skipped'] += len(i.volumes) - len(pending)
+        if not pending:
+            done.append(i.instance_id)
+            continue
+
+        if SNAPSHOT_MODE == 'instance' and len(pending) == len(i.volumes):
+            # One crash-consistent set for all of the instance's volumes, tagged on create
+            response = ec2client.create_snapshots(
+                Description='Backup of {0} - Created {1}'.format(i.name, dates.today_string),
+                InstanceSpecification={'InstanceId': i.instance_id, 'ExcludeBootVolume': False},
+                TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': snapshot_tags(i.name, i.owner, i.application, dates)}]
+            )
+            for snapshot in response['Snapshots']:
+                counters['snapshots'] += 1
+                counters['snapshot_gb'] += snapshot['VolumeSize']
+            done.append(i.instance_id)
+            continue
+
+        # Volume mode, or an instance whose backup was interrupted halfway
+        for volume_id, size in pending:
+            ec2client.create_snapshot(
+                VolumeId=volume_id,
+                Description='Backup of {0}, on volume {1} - Created {2}'.format(
+                    i.name, volume_id, dates.today_string),
+                TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': snapshot_tags(i.name, i.owner, i.application, dates, volume_id)}]
+            )
+            counters['snapshots'] += 1
+            counters['snapshot_gb'] += size
+        done.append(i.instance_id)
+
+    if out_of_time():
+        return counters, done, False
+    # Now sweep the snapshots which were made by auto_snap, once per region
+    deleted, deleted_size = sweep_snapshots(ec2client, region_name, dates, dry_run, by_volume)
+    counters['deleted'] += deleted
+    counters['deleted_gb'] += deleted_size
+    return counters, done, True
+
+
+def resume(context, checkpoint, dry_run):
+    # Continue in a fresh invocation of this function, the checkpoint travels in the event
+    credentialBroker.get_default_client('lambda').invoke(FunctionName=context.invoked_function_arn,
+                                                         InvocationType='Event',
+                                                         Payload=json.dumps({'checkpoint': checkpoint, 'dry_run': dry_run}))
+
+
+@awsMetrics.instrumented('ec2AutomatedBackup')
 def lambda_handler(event, context):
-    snapshot_counter = 0
-    snap_size_counter = 0
-    deletion_counter = 0
-    deleted_size_counter = 0
-
-    for region_name in all_regions:
-        print('Instances in EC2 Region {0}:'.format(region_name))
-        ec2 = boto3.resource('ec2', region_name=region_name)
-
-    # We only want to look through instances with the following tag key value pair: auto_snapshot : true
-        instances = ec2.instances.filter(
-            Filters=[
-                {'Name': 'tag:backup', 'Values': ['true']}
-            ]
-        )
-
-        volume_ids = []
-        for i in instances.all():
-
-            for tag in i.tags:  # Get the name of the instance
-                if tag['Key'] == 'Name':
-                    name = tag['Value']
-                if tag['Key'] == 'owner':
-                    owner = tag['Value']
-                if tag['Key'] == 'application':
-                    application = tag['Value']
-
-            print('Found tagged instance \'{1}\', id: {0}, state: {2}'.format(
-                i.id, name, i.state['Name']))
-
-            vols = i.volumes.all()  # Iterate through each instance's volumes
-            for v in vols:
-                print(
-                    '{0} is attached to volume {1}, proceeding to snapshot'.format(name, v.id))
-                volume_ids.extend(v.id)
-                snapshot = v.create_snapshot(
-                    Description='Backup of {0}, on volume {1} - Created {2}'.format(
-                        name, v.id, today_string),
-                )
-                snapshot.create_tags(  # Add the following tags to the new snapshot
-                    Tags=[
-                        {
-                            'Key': 'lambda_snapshot',
-                            'Value': 'true'
-                        },
-                        {
-                            'Key': 'volume',
-                            'Value': v.id
-                        },
-                        {
-                            'Key': 'CreatedOn',
-                            'Value': today_string
-                        },
-                        {
-                            'Key': 'Name',
-                            'Value': '{} backup'.format(name)
-                        },
-                        {
-                            'Key': 'owner',
-                            'Value': owner
-                        },
-                        {
-                            'Key': 'application',
-                            'Value': application
-                        }
-                    ]
-                )
-                print('Snapshot completed')
-                snapshot_counter += 1
-                snap_size_counter += snapshot.volume_size
-
-                # Now iterate through snapshots which were made by auto_snap
-                snapshots = ec2.snapshots.filter(
-                    Filters=[
-                        {
-                            'Name': 'tag:lambda_snapshot', 'Values': ['true']
-                        }
-                    ]
-                )
-
-                print(
-                    'Checking for out of date snapshots for instance {0}...'.format(name))
-                for snap in snapshots:
-                    can_delete = False
-                    for tag in snap.tags:
-# Use these if statements to get each snapshot's created on date, name and lambda_snapshot tag
-                        if tag['Key'] == 'CreatedOn':
-                            created_on_string = tag['Value']
-                        if tag['Key'] == 'lambda_snapshot':
-                            if tag['Value'] == 'true':
-                                can_delete = True
-                        if tag['Key'] == 'Name':
-                            name = tag['Value']
-                    created_on = datetime.datetime.strptime(
-                        created_on_string, '%Y/%m/%d').date()
-
-                    if created_on <= deletion_date and can_delete == True:
-                        print('Snapshot id {0}, ({1}) from {2} is {3} or more days old... deleting'.format(
-                            snap.id, name, created_on_string, delete_after_days))
-                        deleted_size_counter += snap.volume_size
-                        snap.delete()
-                        deletion_counter += 1
-
-    print('   Made {0} snapshots totalling {1} GB\
-        Deleted {2} snapshots totalling {3} GB'.format(snapshot_counter, snap_size_counter, deletion_counter, deleted_size_counter))
+    # -------------------------------------------------------------------------
+    # The checkpoint in the event (set when the function re-invokes itself) holds
+    # the backup day, the regions completed, the instances done in the other
+    # regions, the running totals and the number of resumes so far.
+    # -------------------------------------------------------------------------
+    event = event or {}
+    dry_run = DRY_RUN or bool(event.get('dry_run'))
+    checkpoint = event.get('checkpoint') or {}
+    if checkpoint:
+        # A resumed run finishes the backup of the day it started on
+        dates = backup_dates(datetime.datetime.strptime(checkpoint['today'], '%Y/%m/%d').date())
+    else:
+        dates = backup_dates()
+    done_regions = set(checkpoint.get('regions', []))
+    done_instances = checkpoint.get('instances', {})
+    totals = collections.Counter(checkpoint.get('totals', {}))
+
+    def out_of_time():
+        return context is not None and context.get_remaining_time_in_millis() < TIME_BUFFER_MS
+
+    all_regions = awsRegions.get_regions(credentialBroker.get_default_client('ec2'))
+    regions = [region_name for region_name in all_regions if region_name not in done_regions]
+    unfinished = {}
+    with ThreadPoolExecutor(max_workers=REGION_WORKERS) as executor:
+        futures = {region_name: executor.submit(backup_region, region_name, dates, dry_run,
+                                                done_instances.get(region_name, []), out_of_time)
+                   for region_name in regions}
+        for region_name, future in futures.items():
+            counters, done, complete = future.result()
+            totals.update(counters)
+            if complete:
+                done_regions.add(region_name)
+            else:
+                unfinished[region_name] = done
+
+    if unfinished:
+        resumes = checkpoint.get('resumes', 0) + 1
+        checkpoint = {'today': dates.today_string, 'regions': sorted(done_regions), 'instances': unfinished,
+                      'totals': dict(totals), 'resumes': resumes}
+        if resumes > MAX_RESUMES:
+            raise RuntimeError('Backup of {0} still unfinished after {1} resumes, left: {2}'.format(
+                dates.today_string, MAX_RESUMES, ', '.join(sorted(unfinished))))
+        print('Out of time with {0} regions left ({1}), resuming from checkpoint ({2} of {3})'.format(
+            len(unfinished), ', '.join(sorted(unfinished)), resumes, MAX_RESUMES))
+        resume(context, checkpoint, dry_run)
+        return checkpoint
+
+    # Totals over every invocation of this backup day
+    awsMetrics.count('Snapshots', totals['snapshots'])
+    awsMetrics.count('SnapshotGB', totals['snapshot_gb'], 'Gigabytes')
+    awsMetrics.count('VolumesSkipped', totals['skipped'])
+    awsMetrics.count('SnapshotsDeleted' if not dry_run else 'SnapshotsToDelete', totals['deleted'])
+    awsMetrics.count('DeletedGB' if not dry_run else 'GBToDelete', totals['deleted_gb'], 'Gigabytes')
+    awsMetrics.count('Resumes', checkpoint.get('resumes', 0))
     return
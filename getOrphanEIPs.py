@@ -2,31 +2,94 @@
 # Find EC2 instances with unassigned elastic IP addresses, print details into an S3 bucket.
 # Invoked by crossAccountMaster.py (requires account details (ARN, eventID, etc.) to run).
 # Gets S3 bucket details from S3_BUCKET environment variable.
+# The role needs s3:GetObject (and s3:ListBucket, or S3 answers a missing key
+# with AccessDenied) to skip unchanged uploads, without them every run uploads.
 # -----------------------------------------------------------------------------
 
 import boto3
 import datetime
+import gzip
+import hashlib
+import json
 import time
 import os
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+import awsMetrics
+import awsRegions
+import credentialBroker
 
-stsclient = boto3.client('sts')
 s3client = boto3.resource('s3')
 
+REGION_WORKERS = int(os.environ.get('REGION_WORKERS', 8))  # Regions scanned concurrently
+
+
+def find_orphan_eips(ec2client, awsregion):
+    # ===================  THIS IS WHERE YOUR JOB STARTS  ==================
+    # ----------------------------------------------------------------------
+    # Returns (region, public ip) for every elastic IP without an association
+    orphans = []
+    response = ec2client.describe_addresses()
+    elasticipslist = response['Addresses']
+    for eip in elasticipslist:
+        if 'AssociationId' not in eip:
+            orphans.append((awsregion, eip['PublicIp']))
+    # ===================  THIS IS WHERE YOUR JOB ENDS  ===================
+    return orphans
+
+def orphan_fingerprint(rows):
+    # Hash of the sorted (region, ip) tuples, identifies an unchanged orphan set
+    return hashlib.sha256('\n'.join(f'{region} {ip}' for region, ip in sorted(rows)).encode()).hexdigest()
+
+
+def load_state(domain, key):
+    # Data file written by the previous run (fingerprint and orphan set), {} on the first run
+    try:
+        body = s3client.Object(domain, key).get()['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return {}
+        if e.response['Error']['Code'] in ('AccessDenied', '403'):
+            print('Cannot read the previous report state {0} ({1}), uploading without the change check'.format(
+                key, e.response['Error']['Code']))
+            return {}
+        raise
+    if body[:2] == b'\x1f\x8b':  # stored with Content-Encoding: gzip
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+
+def render_report(awsaccountid, datafilename):
+    # -----------------------------------------------------------------------
+    # Building the static HTML page, jquery datatables loads the rows from the
+    # JSON data file next to it and only renders the rows on display
+    # -----------------------------------------------------------------------
+    return """<html><head><script src="https://code.jquery.com/jquery-3.3.1.min.js"></script><link rel="stylesheet" type="text/css" href="https://cdn.datatables.net/1.10.16/css/jquery.dataTables.css"><script type="text/javascript" charset="utf8" src="https://cdn.datatables.net/1.10.16/js/jquery.dataTables.js"></script><style>body {font-family: arial;}</style><script>$(document).ready( function () {$('#example').DataTable({ajax: {url: '%(data)s', dataSrc: function (json) {$('#updated').text('last update: ' + json.updated + ' UTC'); return json.data;}}, deferRender: true, columns: [{data: null, defaultContent: '%(account)s'}, {data: 0}, {data: 1}]});} );</script></head><body><table id="example" class="display"><thead><tr><th>AWS Account Id</th><th>AWS Region</th><th>EIP</th></tr></thead></table><p id="updated"></p></body></html>""" % {'data': datafilename, 'account': awsaccountid}
+
+
+def render_data(fingerprint, rows):
+    # Compact JSON rows ([region, ip]) for the report page, doubles as the state of the next run
+    date_now = datetime.date.today()
+    time_now = time.strftime("%H:%M:%S")
+    return json.dumps({'fingerprint': fingerprint, 'updated': f'{date_now} {time_now}', 'data': rows}, separators=(',', ':'))
+
+
+def put_gzip(domain, key, body, content_type, **kwargs):
+    # Stored compressed with Content-Encoding: gzip, browsers inflate it transparently
+    data = gzip.compress(body.encode(), mtime=0)
+    s3client.Object(domain, key).put(Body=data, ContentType=content_type, ContentEncoding='gzip', **kwargs)
+    return len(body.encode()), len(data)
+
+
+@awsMetrics.instrumented('getOrphanEIPs')
 def lambda_handler(event, context):
 
     # -----------------------------------------------------------------------
-    # initiating a session using ARN of the IAM role
+    # cross-account IAM role, assumed (or reused from a warm container) by credentialBroker
     # -----------------------------------------------------------------------
     roleARN = event['ARN']
     roleExternalId = event['externalId']
-    awsaccount = stsclient.assume_role(
-        RoleArn=roleARN,
-        ExternalId=roleExternalId,
-        RoleSessionName='awsaccount_session'
-    )
-    ACCESS_KEY = awsaccount['Credentials']['AccessKeyId']
-    SECRET_KEY = awsaccount['Credentials']['SecretAccessKey']
-    SESSION_TOKEN = awsaccount['Credentials']['SessionToken']
     # -----------------------------------------------------------------------
     # get friendly name of customer
     # -----------------------------------------------------------------------
@@ -34,53 +97,49 @@ def lambda_handler(event, context):
     # -----------------------------------------------------------------------
     # create a list of all currently available aws regions
     # -----------------------------------------------------------------------
-    ec2 = boto3.client('ec2', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, aws_session_token=SESSION_TOKEN)
-    final_awsregionslist = []
-    awsregions = ec2.describe_regions()
-    awsregions_list = awsregions['Regions']
-    for region in awsregions_list:
-        final_awsregionslist.append(region['RegionName'])
-    # -----------------------------------------------------------------------
+    ec2 = credentialBroker.get_client(roleARN, roleExternalId, 'ec2')
     start = '::'
     end = ':'
     awsaccountid = roleARN[roleARN.find(start)+len(start):roleARN.rfind(end)] # getting awsaccount ID from IAM Role ARN
+    final_awsregionslist = awsRegions.get_regions(ec2, cache_key=awsaccountid)
 
     # -----------------------------------------------------------------------
-    # Building HTML page/table using jquery datatables
+    # scan all exisiting aws regions concurrently, collecting orphan EIP rows
     # -----------------------------------------------------------------------
-    date_now = datetime.date.today()
-    time_now = time.strftime("%H:%M:%S")
-    creationdatetime = f'last update: {date_now} {time_now} UTC'
-    payload_start = """<html><head><script src="https://code.jquery.com/jquery-3.3.1.min.js"></script><link rel="stylesheet" type="text/css" href="https://cdn.datatables.net/1.10.16/css/jquery.dataTables.css"><script type="text/javascript" charset="utf8" src="https://cdn.datatables.net/1.10.16/js/jquery.dataTables.js"></script><script>$(document).ready( function () {$('#example').DataTable();} );</script></head><body><table id="example" class="display"><thead><tr><th><font face="arial">AWS Account Id</font></th><th><font face="arial">AWS Region</font></th><th><font face="arial">EIP</font></th></tr></thead><tbody>"""
+    rows = []
+    with ThreadPoolExecutor(max_workers=REGION_WORKERS) as executor:
+        # Open ec2 session for current aws account (arn) and each region, clients are
+        # created up front because creating them is not thread safe.
+        futures = [executor.submit(find_orphan_eips, credentialBroker.get_client(roleARN, roleExternalId, 'ec2', awsregion), awsregion)
+                   for awsregion in final_awsregionslist]
+        for future in futures:
+            rows.extend(future.result())
 
-    # -----------------------------------------------------------------------
-    # loop through all exisiting aws regions
-    # -----------------------------------------------------------------------
-    for awsregion in final_awsregionslist:
-        # ===================  THIS IS WHERE YOUR JOB STARTS  ==================
-        # ----------------------------------------------------------------------
-        # Open ec2 session for current aws account (arn) and region
-        ec2client = boto3.client('ec2', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, aws_session_token=SESSION_TOKEN, region_name=awsregion)
-
-        # ----------------------------------------------------------------------
-        response = ec2client.describe_addresses()
-        elasticipslist = response['Addresses']
-        for eip in elasticipslist:
-            if 'AssociationId' not in eip:
-                elastic_ip = eip['PublicIp']
-                # --------------------------------------------------------------
-                # Building HTML page/table
-                loopstring = f'<tr><td><font face="arial">{awsaccountid}</font></td><td><font face="arial">{awsregion}</font></td><td><font face="arial">{elastic_ip}</font></td></tr>'
-                payload_start = payload_start + loopstring
-        payload_end = f'</tbody></table><p>{creationdatetime}</p></body></html>'
-        finalpayload = payload_start + payload_end
-        # --------------------------------------------------------------
-        bucketPath = customerName + '/'
-        htmlfilename = f'awsaccount-{awsaccountid}-EIPs.html'  # making unique name for HTML file
-        if os.environ.get('S3_BUCKET'):
-            domain = os.environ.get('S3_BUCKET')  # S3 bucket name where HTML page will be saved (must be changed)
-            s3client.Object(domain, bucketPath + htmlfilename).put(Body=finalpayload, ContentType='text/html')
-        else:
-            print("No target S3 bucket identified so printing to stdout...")
-            print(finalpayload)
-        # ===================  THIS IS WHERE YOUR JOB ENDS  ===================
+    rows = sorted(rows)
+    fingerprint = orphan_fingerprint(rows)
+    # --------------------------------------------------------------
+    bucketPath = customerName + '/'
+    htmlfilename = f'awsaccount-{awsaccountid}-EIPs.html'  # making unique name for HTML file
+    datafilename = f'awsaccount-{awsaccountid}-EIPs.json'  # rows of the page, fingerprint and orphan set of the last upload
+    if os.environ.get('S3_BUCKET'):
+        domain = os.environ.get('S3_BUCKET')  # S3 bucket name where HTML page will be saved (must be changed)
+        previous = load_state(domain, bucketPath + datafilename)
+        previous_rows = set(tuple(row) for row in previous.get('data', previous.get('addresses', [])))
+        # machine readable diff for downstream alerting
+        print(json.dumps({'account': awsaccountid, 'customerName': customerName, 'fingerprint': fingerprint,
+                          'changed': previous.get('fingerprint') != fingerprint,
+                          'added': [list(row) for row in rows if row not in previous_rows],
+                          'released': [list(row) for row in sorted(previous_rows - set(rows))]}))
+        # Upload only when the orphan set changed since the last run
+        if previous.get('fingerprint') != fingerprint:
+            html_size = put_gzip(domain, bucketPath + htmlfilename, render_report(awsaccountid, datafilename), 'text/html',
+                                 Metadata={'orphan-fingerprint': fingerprint})
+            data_size = put_gzip(domain, bucketPath + datafilename, render_data(fingerprint, rows), 'application/json')
+            awsMetrics.count('ReportsUploaded')
+            awsMetrics.count('ReportBytes', html_size[0] + data_size[0], 'Bytes')
+            awsMetrics.count('ReportBytesGzipped', html_size[1] + data_size[1], 'Bytes')
+    else:
+        print("No target S3 bucket identified so printing to stdout...")
+        print(render_data(fingerprint, rows))
+    awsMetrics.count('OrphanEIPs', len(rows))
+    awsMetrics.count('Regions', len(final_awsregionslist))
@@ -0,0 +1,167 @@
+# -----------------------------------------------------------------------------
+# Runs the cross-account job suite on one machine, without Lambda.
+# Reads the account list (SSM like crossAccountMaster.py, or a local JSON/CSV
+# file), then runs every child handler for every account in-process across a
+# pool of worker processes and prints one report with per-account status and
+# timings. Meant for backfills and ops runs.
+#
+#   python localRunner.py --accounts accounts.json --workers 8
+#   python localRunner.py --endpoint-url http://localhost:5000   # stubbed AWS
+#
+# The accounts file holds the child events, a JSON list of
+# {"ARN": ..., "externalId": ..., "customerName": ...} or a CSV with those columns.
+# -----------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import csv
+import importlib.util
+import json
+import os
+import sys
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import awsMetrics
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+# Lambda function name (as in crossAccountMaster's CHILD_FUNCTIONS) -> source file and handler
+CHILD_HANDLERS = {
+    'createCostExplorerReport': ('costExplorerReport-lambda.py', 'main_handler'),
+    'getOrphanEIPs': ('getOrphanEIPs.py', 'lambda_handler'),
+}
+RUNNER_WORKERS = int(os.environ.get('RUNNER_WORKERS', os.cpu_count() or 1))  # Handler runs in parallel
+RUNNER_TIMEOUT = int(os.environ.get('RUNNER_TIMEOUT', 900))  # Seconds reported by get_remaining_time_in_millis
+
+_handlers = {}
+
+
+class LocalContext(object):
+    # Minimal stand-in for the Lambda context object handed to the handlers
+    def __init__(self, function_name, timeout):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self.memory_limit_in_mb = 0
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+def load_handler(function_name):
+    # Handlers are imported once per worker process, costExplorerReport-lambda.py
+    # has a dash in its name so everything is loaded from its file path
+    if function_name not in _handlers:
+        filename, handler_name = CHILD_HANDLERS[function_name]
+        if BASE_DIR not in sys.path:
+            sys.path.insert(0, BASE_DIR)
+        module_name = os.path.splitext(filename)[0].replace('-', '_')
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(BASE_DIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _handlers[function_name] = getattr(module, handler_name)
+    return _handlers[function_name]
+
+
+def load_accounts(path=None):
+    # -------------------------------------------------------------------------
+    # Child events from a local JSON or CSV file, from SSM when path is None
+    # -------------------------------------------------------------------------
+    if path is None:
+        import crossAccountMaster
+        return crossAccountMaster.get_accounts()
+    with open(path) as f:
+        if path.endswith('.csv'):
+            return [{'ARN': row['ARN'], 'externalId': row['externalId'], 'customerName': row['customerName']}
+                    for row in csv.DictReader(f)]
+        return json.load(f)
+
+
+def run_child(function_name, event, timeout=RUNNER_TIMEOUT, log_dir=None):
+    # -------------------------------------------------------------------------
+    # Runs one handler for one account in the worker process. Output goes to
+    # <log_dir>/<customerName>-<function>.log when log_dir is set.
+    # Returns the result row for the report.
+    # -------------------------------------------------------------------------
+    result = {'account': event['ARN'].split(':')[4], 'customerName': event.get('customerName', ''),
+              'function': function_name, 'status': 'ok', 'seconds': 0.0, 'error': None}
+    started = time.monotonic()
+    with contextlib.ExitStack() as stack:
+        if log_dir:
+            log = stack.enter_context(open(os.path.join(log_dir, '{0}-{1}.log'.format(result['customerName'] or result['account'], function_name)), 'w'))
+            stack.enter_context(contextlib.redirect_stdout(log))
+            stack.enter_context(contextlib.redirect_stderr(log))
+        try:
+            load_handler(function_name)(dict(event), LocalContext(function_name, timeout))
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = '{0}: {1}'.format(type(e).__name__, (str(e).strip().splitlines() or [''])[0])
+            traceback.print_exc()
+    result['seconds'] = time.monotonic() - started
+    return result
+
+
+def run(accounts, functions, workers=RUNNER_WORKERS, timeout=RUNNER_TIMEOUT, log_dir=None):
+    # -------------------------------------------------------------------------
+    # Runs every function for every account across a process pool, returns the
+    # result rows (sorted by account and function) and the wall time
+    # -------------------------------------------------------------------------
+    started = time.monotonic()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_child, function_name, event, timeout, log_dir)
+                   for event in accounts for function_name in functions]
+        for future in as_completed(futures):
+            results.append(future.result())
+    results.sort(key=lambda row: (row['customerName'], row['account'], row['function']))
+    return results, time.monotonic() - started
+
+
+def print_report(results, wall_seconds):
+    print('{0:<24} {1:<14} {2:<26} {3:<6} {4:>9}  {5}'.format('Customer', 'Account', 'Function', 'Status', 'Seconds', 'Error'))
+    for row in results:
+        print('{0:<24} {1:<14} {2:<26} {3:<6} {4:>9.2f}  {5}'.format(
+            row['customerName'], row['account'], row['function'], row['status'], row['seconds'], row['error'] or ''))
+    for function_name in sorted(set(row['function'] for row in results)):
+        seconds = [row['seconds'] for row in results if row['function'] == function_name]
+        print('{0}: {1} runs, p50 {2:.2f} s, p99 {3:.2f} s, max {4:.2f} s'.format(
+            function_name, len(seconds), awsMetrics.percentile(seconds, 50), awsMetrics.percentile(seconds, 99), max(seconds)))
+    failed = sum(1 for row in results if row['status'] != 'ok')
+    print('Ran {0} handlers for {1} accounts in {2:.2f} s, {3} failed'.format(
+        len(results), len(set(row['account'] for row in results)), wall_seconds, failed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the cross-account child handlers locally.')
+    parser.add_argument('--accounts', help='JSON or CSV file with the accounts, read from SSM when omitted')
+    parser.add_argument('--functions', default=os.environ.get('CHILD_FUNCTIONS', ','.join(CHILD_HANDLERS)),
+                        help='comma separated child functions, default: %(default)s')
+    parser.add_argument('--workers', type=int, default=RUNNER_WORKERS, help='worker processes, default: %(default)s')
+    parser.add_argument('--timeout', type=int, default=RUNNER_TIMEOUT, help='seconds given to each handler run, default: %(default)s')
+    parser.add_argument('--endpoint-url', help='send every AWS call to this endpoint, e.g. a local stub')
+    parser.add_argument('--log-dir', help='write each handler run\'s output to its own file in this directory')
+    parser.add_argument('--report', help='also write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    if args.endpoint_url:
+        # Read by botocore in the parent and in every worker process
+        os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url
+    functions = [name.strip() for name in args.functions.split(',') if name.strip()]
+    unknown = [name for name in functions if name not in CHILD_HANDLERS]
+    if unknown:
+        parser.error('unknown child function(s): {0}'.format(', '.join(unknown)))
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    results, wall_seconds = run(load_accounts(args.accounts), functions, args.workers, args.timeout, args.log_dir)
+    print_report(results, wall_seconds)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'wall_seconds': wall_seconds, 'results': results}, f, indent=2)
+    return 1 if any(row['status'] != 'ok' for row in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())